@@ -6,10 +6,24 @@ from langchain.memory import ConversationBufferMemory
 from llm import get_llm
 from rag_tools import rag_tool, summarise_patient_report, interpret_lab
 from web_tools import get_web_tools   # <-- NEW
+from tracing import span
+
+
+# Every tool call shows up as a span in the turn's trace
+def _traced(tool: Tool) -> Tool:
+    func = tool.func
+
+    def run(tool_input, *args, **kwargs):
+        with span(f"tool.{tool.name}", kind="tool", input=str(tool_input)[:200]) as sp:
+            out = func(tool_input, *args, **kwargs)
+            sp.set(output_chars=len(str(out)))
+            return out
+
+    return Tool(name=tool.name, func=run, description=tool.description)
 
 #To create a langchain agent
 def create_agent(general_index: str, patient_index: str, session_id: str):
-    llm = get_llm() # Get a defined llm
+    llm = get_llm() # Shared, pooled llm client
     memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True) # Define conversation buffer memory
 
     # Bind params for RAG tools
@@ -39,6 +53,7 @@ def create_agent(general_index: str, patient_index: str, session_id: str):
 
     # Append web search tools
     tools += get_web_tools(num_results=5)
+    tools = [_traced(t) for t in tools]
 
     system_msg = (
         "Patient and helpbook docs are embedded for THIS session. "
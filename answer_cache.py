@@ -0,0 +1,122 @@
+# ===========================================
+# file: answer_cache.py
+# Semantic per-session answer cache
+# ===========================================
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+# Cosine similarity at which two questions count as "the same question"
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+ANSWER_CACHE_TTL_S = float(os.getenv("ANSWER_CACHE_TTL_S", "1800"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "512"))
+
+_lock = threading.Lock()
+# session_id -> versions (content hashes) of every document ingested for that session
+_session_docs: Dict[str, Set[str]] = {}
+# entry id -> entry, oldest/least recently used first
+_entries: "OrderedDict[int, dict]" = OrderedDict()
+_next_id = 0
+_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def _unit(vec: List[float]) -> np.ndarray:
+    v = np.asarray(vec, dtype=np.float32)
+    n = float(np.linalg.norm(v))
+    return v / n if n else v
+
+
+def _docs_version(session_id: str) -> str:
+    docs = sorted(_session_docs.get(session_id, ()))
+    return hashlib.sha256("|".join(docs).encode("utf-8")).hexdigest()
+
+
+def docs_version(session_id: str) -> str:
+    """Fingerprint of the documents currently ingested for the session."""
+    with _lock:
+        return _docs_version(session_id)
+
+
+def _drop_session_entries(session_id: str):
+    for key in [k for k, e in _entries.items() if e["session_id"] == session_id]:
+        _entries.pop(key)
+
+
+def note_session_documents(session_id: str, versions: Iterable[str]):
+    """Record newly ingested document versions; cached answers for the session become stale."""
+    with _lock:
+        _session_docs.setdefault(session_id, set()).update(versions)
+        _drop_session_entries(session_id)
+
+
+def forget_session(session_id: str):
+    with _lock:
+        _session_docs.pop(session_id, None)
+        _drop_session_entries(session_id)
+
+
+def lookup(session_id: str, question_vec: Optional[List[float]] = None,
+           key: Optional[str] = None) -> Optional[Tuple[str, str]]:
+    """
+    Best cached (answer, context) for a question with similarity >= ANSWER_CACHE_SIMILARITY,
+    from the same session and the same set of ingested documents. None on a miss.
+    With `key`, only an entry stored under exactly that key matches (templated prompts,
+    where one changed word would still clear the similarity threshold).
+    """
+    q = _unit(question_vec) if key is None else None
+    now = time.monotonic()
+    with _lock:
+        version = _docs_version(session_id)
+        best_key, best_sim = None, ANSWER_CACHE_SIMILARITY
+        for entry_id, e in list(_entries.items()):
+            if now - e["created_at"] > ANSWER_CACHE_TTL_S:
+                _entries.pop(entry_id)
+                continue
+            if e["session_id"] != session_id or e["docs_version"] != version or e["key"] != key:
+                continue
+            sim = 1.0 if key is not None else float(e["vec"] @ q)
+            if sim >= best_sim:
+                best_key, best_sim = entry_id, sim
+        if best_key is None:
+            _stats["misses"] += 1
+            return None
+        _entries.move_to_end(best_key)
+        _stats["hits"] += 1
+        e = _entries[best_key]
+        return e["answer"], e["context"]
+
+
+def store(session_id: str, question_vec: Optional[List[float]], answer: str, context: str = "",
+          version: Optional[str] = None, key: Optional[str] = None):
+    """
+    Cache an answer. Pass the docs_version() taken before answering so an answer
+    built from older documents is never filed under a newer ingest. Keyed entries
+    (see lookup) need no question vector.
+    """
+    global _next_id
+    with _lock:
+        if version is not None and version != _docs_version(session_id):
+            return
+        _entries[_next_id] = {
+            "session_id": session_id,
+            "docs_version": _docs_version(session_id),
+            "key": key,
+            "vec": _unit(question_vec) if key is None else None,
+            "answer": answer,
+            "context": context,
+            "created_at": time.monotonic(),
+        }
+        _next_id += 1
+        while len(_entries) > ANSWER_CACHE_MAX_ENTRIES:
+            _entries.popitem(last=False)
+            _stats["evictions"] += 1
+
+
+def cache_stats() -> Dict[str, int]:
+    with _lock:
+        return dict(_stats, entries=len(_entries))
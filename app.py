@@ -1,6 +1,9 @@
 # ===========================================
 # Streamlit app: upload, chat, purge
 # ===========================================
+import time
+_rerun_t0 = time.perf_counter()  # measure per-rerun setup overhead
+
 import os
 import uuid
 import streamlit as st
@@ -11,12 +14,19 @@ from agent import create_agent
 from ingest import ingest_helpbook_pdf, ingest_patient_files
 from vectorstore import (
     ensure_indexes,
-    drop_patient_index,
+    delete_patient_session_vectors,
 )
-
-import time
-from rag import get_last_context, get_last_metrics
-from metrics import summarize_session, append_session_summary
+from janitor import start_janitor, forget_session
+import answer_cache
+import labs
+from rag_tools import forget_summary
+
+from rag import clear_session_memory, stream_tokens_to, turn_context, turn_metrics
+from tracing import start_trace
+import trace_export
+from metrics import start_session_summary_job
+from metrics_store import get_metrics_store
+from embeddings import warmup as warmup_embeddings
 
 load_dotenv()
 
@@ -135,7 +145,7 @@ if "messages" not in st.session_state:
     st.session_state.messages = []  # [{"role":"user"/"assistant","content": "..."}]
 
 if "turn_log" not in st.session_state:
-    st.session_state.turn_log = []  # list of {"q","answer","context","ts"}
+    st.session_state.turn_log = []  # list of {"q","answer","context","metrics","trace","ts"}
 
 # NEW: gate chat until patient docs are embedded
 if "patient_ingested" not in st.session_state:
@@ -147,7 +157,24 @@ GENERAL_INDEX_NAME = os.getenv("GENERAL_INDEX_NAME", "medical-helpbook") # Pinec
 PATIENT_INDEX_NAME = os.getenv("PATIENT_INDEX_NAME", "patient-reports") # Pinecone index name 2
 region = os.getenv("PINECONE_REGION", "us-east-1")
 
-# Create agent for each session
+# Load the shared embedding model once per process (not on the first question)
+@st.cache_resource(show_spinner="Loading embedding model...")
+def _warm_embedding_model():
+    return warmup_embeddings()
+
+_warm_embedding_model()
+
+# Indexes are created at deployment (python vectorstore.py); this is a once-per-process guard,
+# not something every button press pays for. The janitor purges sessions idle past SESSION_TTL_S.
+@st.cache_resource(show_spinner="Connecting to vector indexes...")
+def _init_indexes():
+    ensure_indexes(GENERAL_INDEX_NAME, PATIENT_INDEX_NAME, region=region)
+    start_janitor()
+    return True
+
+_init_indexes()
+
+# Create agent once per session (shared LLM / web tools / embeddings come from resources.py)
 if "agent" not in st.session_state or st.session_state.get("_agent_session_id") != st.session_state.session_id:
     st.session_state.agent, st.session_state.agent_memory = create_agent(
         general_index=GENERAL_INDEX_NAME,
@@ -159,11 +186,6 @@ if "agent" not in st.session_state or st.session_state.get("_agent_session_id")
 # Sidebar: File Uploads and session reset
 with st.sidebar:
 
-    agent, agent_memory = create_agent(
-    general_index=GENERAL_INDEX_NAME,
-    patient_index=PATIENT_INDEX_NAME,
-    session_id=st.session_state.session_id,
-)
     # Tabs in sidebar
     patientReports,GeneralDocument=st.tabs(["Patient reports","General Helper documents"])
     # Tab 1: To upload and process patient report
@@ -181,24 +203,29 @@ with st.sidebar:
                 st.warning("Please upload at least one patient file.")
             else:
                 try:
-                    # Ensure index and ingest files into pinecone
-                    ensure_indexes(GENERAL_INDEX_NAME, PATIENT_INDEX_NAME, region=region)
-                    count = ingest_patient_files(
+                    # Ingest files into this session's partition
+                    result = ingest_patient_files(
                         files,
                         PATIENT_INDEX_NAME,
                         session_id=st.session_state.session_id,
+                        summary_general_index=GENERAL_INDEX_NAME,  # precompute the summary
                     )
+                    count = result["chunks"]
                     if count > 0:
                         st.session_state.patient_ingested = True  # allow chat
 
                         # Reset chat + agent memory so next turn uses the fresh docs
                         st.session_state.messages = []
                         try:
-                            agent_memory.clear()  # local variable from create_agent(...)
+                            st.session_state.agent_memory.clear()  # per-session agent memory
                         except Exception:
                             pass
 
-                        st.success(f"Embedded {count} chunks for this session. Chat is now enabled.")
+                        st.success(
+                            f"Processed {count} chunks for this session "
+                            f"({result['new']} new, {result['updated']} updated, {result['skipped']} unchanged). "
+                            f"Chat is now enabled."
+                        )
                         st.rerun()  # refresh UI immediately
                     else:
                         st.warning("No content was ingested. Please check the files and try again.")
@@ -216,32 +243,52 @@ with st.sidebar:
                 st.warning("Please upload a helpbook PDF first.")
             else:
                 try:
-                    # Ensure index and ingest documents
-                    ensure_indexes(GENERAL_INDEX_NAME, PATIENT_INDEX_NAME, region=region)
-                    pages = ingest_helpbook_pdf(help_pdf, GENERAL_INDEX_NAME)
-                    st.success(f"Embedded {pages} pages into '{GENERAL_INDEX_NAME}'.")
+                    # Ingest documents (streamed page by page, progress in the sidebar)
+                    bar = st.progress(0.0, text="Reading helpbook...")
+
+                    def _on_progress(pages_done, total_pages, chunks):
+                        bar.progress(
+                            pages_done / max(1, total_pages),
+                            text=f"Page {pages_done}/{total_pages} - {chunks} chunks processed",
+                        )
+
+                    result = ingest_helpbook_pdf(help_pdf, GENERAL_INDEX_NAME, on_progress=_on_progress)
+                    bar.empty()
+                    st.success(
+                        f"Processed {result['chunks']} chunks into '{GENERAL_INDEX_NAME}' "
+                        f"({result['new']} new, {result['updated']} updated, {result['skipped']} unchanged, "
+                        f"{result['removed']} removed, {result['pages_per_s']} pages/s, "
+                        f"{result['chunks_per_s']} chunks/s). {result['pages_unchanged']} pages were unchanged; "
+                        f"helpbook version {result['version']} is live."
+                    )
                 except Exception as e:
                     st.error(f"Failed to embed helpbook: {e}")
     st.markdown("---")
     if st.button("Process new report"):
         try:
-            # Extract performance metrics after every run      
-            summary = summarize_session(st.session_state.turn_log)
-            append_session_summary(
+            # Purge only this session's vectors (other users' sessions are untouched)
+            old_session_id = st.session_state.session_id
+            # Not waited on: Pinecone finishes the delete in the background, the button returns now
+            purged = delete_patient_session_vectors(PATIENT_INDEX_NAME, old_session_id, wait=False)
+
+            # Score the finished session in the background (judge calls run off the UI path).
+            # Only once the purge went through, so a failed reset + retry doesn't log it twice
+            st.session_state.eval_job = start_session_summary_job(
+                st.session_state.turn_log,
                 csv_path="session_metrics.csv",
-                session_id=st.session_state.session_id,
-                summary=summary,
+                session_id=old_session_id,
                 extra={"patient_index": PATIENT_INDEX_NAME, "general_index": GENERAL_INDEX_NAME},
-            )  
-
-            # Refresh patient index and refresh session    
-            drop_patient_index(PATIENT_INDEX_NAME)
-            ensure_indexes(GENERAL_INDEX_NAME, PATIENT_INDEX_NAME, region=region)
+            )
+            forget_session(PATIENT_INDEX_NAME, old_session_id)
+            clear_session_memory(old_session_id)
+            answer_cache.forget_session(old_session_id)
+            forget_summary(old_session_id)
+            labs.forget_session(old_session_id)
 
             # Clear chat + agent memory, rotate session, and lock chat until new upload
             st.session_state.messages = []
             try:
-                agent_memory.clear()  # clear the agent's ConversationBufferMemory
+                st.session_state.agent_memory.clear()  # clear the agent's ConversationBufferMemory
             except Exception:
                 pass
 
@@ -249,11 +296,31 @@ with st.sidebar:
             st.session_state.session_id = str(uuid.uuid4())
             st.session_state.patient_ingested = False  # ⬅️ gate chat again
 
-            st.success(f"Patient index '{PATIENT_INDEX_NAME}' deleted and recreated. New conversation started.")
-            st.info(" All patient data has been permanently deleted.")
+            st.success("Session data purged. New conversation started.")
+            if purged:
+                st.info(" All patient data for this session has been permanently deleted.")
+            else:
+                st.info(" Patient data for this session is being deleted in the background.")
             st.rerun()
         except Exception as e:
-            st.error(f"Failed to reset patient index: {e}")
+            st.error(f"Failed to reset session: {e}")
+
+    # Status of the last session's background evaluation
+    eval_job = st.session_state.get("eval_job")
+    if eval_job is not None:
+        if not eval_job.done():
+            st.caption("Scoring previous session...")
+        elif eval_job.exception() is not None:
+            st.caption(f"Session scoring failed: {eval_job.exception()}")
+        else:
+            st.caption(f"Previous session scored ({eval_job.result()['turns_scored']} turns).")
+
+    # Setup cost of this rerun (imports, session bootstrap, cached resources, sidebar)
+    st.session_state.rerun_overhead_ms = round((time.perf_counter() - _rerun_t0) * 1000, 1)
+    st.caption(f"Rerun overhead: {st.session_state.rerun_overhead_ms} ms")
+    if trace_export.enabled():
+        # Opt-in: run the next turns under the sampling profiler (stacks land in the trace export)
+        st.checkbox("Profile chat turns", key="profile_turn")
 
 # Main page with chat window
 with st.expander("About the app.."):  
@@ -278,26 +345,34 @@ else:
             st.markdown(user_msg)
 
         with st.chat_message("assistant"):
+            # RAG answer tokens are rendered here as they arrive
+            placeholder = st.empty()
+            streamed = []
+            def _on_token(tok: str):
+                streamed.append(tok)
+                placeholder.markdown("".join(streamed) + "▌")
+
             with st.spinner("Thinking..."):
                 try:
-                    # Run the agent to get the response to user query
-                    response = st.session_state.agent.run(user_msg)
-                    ctx = ""
-                    try: ctx = get_last_context()
-                    except: pass
-                    m = {}
-                    try: m = get_last_metrics() or {}
-                    except: pass
+                    # Run the agent to get the response to user query (one trace per turn)
+                    with start_trace("turn", session_id=st.session_state.session_id) as trace, \
+                            trace_export.profiling(trace, force=st.session_state.get("profile_turn") or None):
+                        with stream_tokens_to(_on_token):
+                            response = st.session_state.agent.run(user_msg)
+                    trace_export.export_turn(trace, question=user_msg, answer=response)
+                    metrics = turn_metrics(trace)
+                    get_metrics_store().record_turn(st.session_state.session_id, metrics, ts=trace.started_at)
 
                     st.session_state.turn_log.append({
                         "q": user_msg,
                         "answer": response,
-                        "context": ctx,
-                        "metrics": m,
+                        "context": turn_context(trace),   # every RAG call in the turn
+                        "metrics": metrics,               # flat view for the session summary
+                        "trace": trace.to_dict(),         # full span tree
                         "ts": time.strftime("%Y-%m-%d %H:%M:%S"),
                     })
                 except Exception as e:
                     response = f"Sorry, something went wrong: {e}"
-            # Display the response
-            st.markdown(response)
+            # Display the final response (replaces the streamed draft)
+            placeholder.markdown(response)
         st.session_state.messages.append({"role": "assistant", "content": response})
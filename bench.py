@@ -0,0 +1,303 @@
+# ===========================================
+# file: bench.py
+# Offline replay benchmark: local vector index + stub LLM, JSON report
+#
+#   python bench.py --questions questions.jsonl --reports report.pdf --concurrency 8
+#   python bench.py --mode agent --hash-embeddings --llm-latency-ms 300 --out bench.json
+# ===========================================
+import os
+import io
+import sys
+import json
+import math
+import time
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+SAMPLE_QUESTIONS = [
+    "What is my haemoglobin level and is it normal?",
+    "Summarise the abnormal results in my report.",
+    "Is my fasting blood sugar within the reference range?",
+    "What does a high TSH mean?",
+    "Are my platelets low?",
+    "Explain my white blood cell count.",
+]
+
+SAMPLE_REPORT = """Complete Blood Count
+Haemoglobin (Hb)   11.1  L  g/dL   12.0 - 15.0
+Total Leucocyte Count   7800  /cumm   4000 - 11000
+Platelet count: 250 x10^9/L (150-400)
+Haematocrit (PCV)   34.2  L  %   36 - 46
+
+Biochemistry
+Fasting Blood Sugar   112  H  mg/dL   70 - 100
+HbA1c   6.1  %   4.0 - 5.6
+TSH   5.8  H  uIU/mL   0.4 - 4.0
+
+Advisory: mild anaemia and impaired fasting glucose. Please consult your physician.
+"""
+
+
+def _configure(args):
+    # Settings are read at import time, so the environment is set before importing the app
+    work = args.work_dir or tempfile.mkdtemp(prefix="bench-")
+    os.environ["VECTOR_BACKEND"] = "local"
+    os.environ["LLM_BACKEND"] = "stub"
+    os.environ["LLM_STUB_LATENCY_MS"] = str(args.llm_latency_ms)
+    os.environ["LLM_MAX_CONCURRENCY"] = str(args.llm_concurrency)
+    os.environ["LOCAL_INDEX_DIR"] = os.path.join(work, "vector_index")
+    os.environ["HELPBOOK_MANIFEST_DIR"] = os.path.join(work, "helpbook_manifest")
+    os.environ["EMBED_CACHE_DIR"] = os.path.join(work, "embed_cache") if args.embed_cache else ""
+    os.environ["HISTORY_BACKEND"] = "memory"
+    os.environ["TRACE_EXPORT_PATH"] = ""
+    return work
+
+
+def _install_hash_embeddings():
+    """Deterministic hashed bag-of-words vectors instead of the transformer (no model download)."""
+    import hashlib
+    import numpy as np
+    from embeddings import EmbeddingEngine
+    from resources import get_resource
+    from vectorstore import EMBED_DIM
+
+    class HashEmbeddingEngine(EmbeddingEngine):
+        def _encode(self, texts: List[str]) -> List[List[float]]:
+            out = []
+            for t in texts:
+                v = np.zeros(EMBED_DIM, dtype=np.float32)
+                for w in t.lower().split():
+                    h = int.from_bytes(hashlib.blake2b(w.encode("utf-8"), digest_size=4).digest(), "little")
+                    v[h % EMBED_DIM] += 1.0
+                n = float(np.linalg.norm(v)) or 1.0
+                out.append((v / n).tolist())
+            return out
+
+    # Registered before anything asks for "embeddings", so every caller gets this one
+    get_resource("embeddings", lambda: HashEmbeddingEngine(model_name="hash-bow"))
+
+
+def _load_questions(path: Optional[str]) -> List[str]:
+    """
+    JSONL with a "question" (or "q") field per line, or plain text with one question per line.
+    A trace_export file works too: its "turn" records carry "question" when it was recorded
+    with TRACE_EXPORT_QUESTIONS=1 (ingest records are skipped).
+    """
+    if not path:
+        return list(SAMPLE_QUESTIONS)
+    out = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                out.append(line)
+                continue
+            if isinstance(rec, dict):
+                q = rec.get("question") or rec.get("q")
+                if q:
+                    out.append(str(q))
+            else:
+                out.append(str(rec))
+    if not out:
+        raise SystemExit(f"No questions in {path} (trace exports need TRACE_EXPORT_QUESTIONS=1)")
+    return out
+
+
+class _Upload(io.BytesIO):
+    """Stands in for Streamlit's UploadedFile."""
+
+    def __init__(self, name: str, data: bytes):
+        super().__init__(data)
+        self.name = name
+
+
+def _load_reports(paths: List[str]) -> List[_Upload]:
+    if not paths:
+        return [_Upload("sample_report.txt", SAMPLE_REPORT.encode("utf-8"))]
+    uploads = []
+    for p in paths:
+        with open(p, "rb") as f:
+            uploads.append(_Upload(os.path.basename(p), f.read()))
+    return uploads
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"n": 0}
+    xs = sorted(values)
+
+    def q(p: float) -> float:
+        # nearest-rank
+        return round(xs[max(0, math.ceil(p * len(xs)) - 1)], 1)
+
+    return {"n": len(xs), "p50": q(0.50), "p95": q(0.95), "p99": q(0.99),
+            "mean": round(sum(xs) / len(xs), 1), "max": round(xs[-1], 1)}
+
+
+def _peak_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KiB on Linux, bytes on macOS
+    return round(rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024, 1)
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       text=True).strip()
+    except Exception:
+        return None
+
+
+def run(args) -> Dict:
+    work = _configure(args)
+    if args.hash_embeddings:
+        _install_hash_embeddings()
+
+    # App modules are imported only now (see _configure)
+    from ingest import ingest_helpbook_pdf, ingest_patient_files
+    from rag import answer_question, turn_context
+    from rag_tools import rag_tool, summarise_patient_report
+    from tracing import span, start_trace
+    from trace_export import turn_record
+    from vectorstore import ensure_indexes
+    from embeddings import get_embeddings
+
+    general, patient = "bench-helpbook", "bench-patient"
+    ensure_indexes(general, patient)
+    t0 = time.perf_counter()
+    get_embeddings().warmup()
+    warmup_ms = (time.perf_counter() - t0) * 1000
+
+    helpbook = None
+    if args.helpbook:
+        with open(args.helpbook, "rb") as f:
+            helpbook = ingest_helpbook_pdf(_Upload(os.path.basename(args.helpbook), f.read()), general)
+
+    # One session per virtual user, each with its own copy of the reports
+    sessions = [f"bench-{i}" for i in range(args.concurrency)]
+    ingests = []
+    for sid in sessions:
+        ingests.append(ingest_patient_files(_load_reports(args.reports), patient, session_id=sid))
+
+    agents = {}
+    if args.mode == "agent":
+        from agent import create_agent
+        agents = {sid: create_agent(general, patient, sid)[0] for sid in sessions}
+
+    questions = _load_questions(args.questions)
+    work_items = [questions[i % len(questions)] for i in range(args.turns or len(questions))]
+
+    lock = threading.Lock()
+    turns: List[Dict] = []
+    failures: List[str] = []
+
+    def one_turn(i: int, q: str):
+        sid = sessions[i % len(sessions)]
+        try:
+            with start_trace("turn", session_id=sid) as root:
+                if args.mode == "agent":
+                    answer = agents[sid].run(q)
+                elif args.mode == "tool":
+                    answer = rag_tool(q, general, patient, sid)
+                else:
+                    with span("rag.answer", kind="rag"):
+                        answer = answer_question(q, general, patient, sid)
+            rec = turn_record(root, q, answer)
+            with lock:
+                turns.append(rec)
+        except Exception as e:
+            with lock:
+                failures.append(f"{type(e).__name__}: {e}")
+
+    # Agents keep per-session memory, so each session's turns run on one worker at a time
+    t_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="bench") as pool:
+        if args.mode == "agent":
+            def session_loop(s: int):
+                for i in range(s, len(work_items), len(sessions)):
+                    one_turn(i, work_items[i])
+            list(pool.map(session_loop, range(len(sessions))))
+        else:
+            list(pool.map(lambda iq: one_turn(*iq), enumerate(work_items)))
+    wall_s = time.perf_counter() - t_start
+
+    # Sanity checks (outside the timed loop): a summary turn must carry its context,
+    # or faithfulness judging and the metrics pipeline silently skip it
+    with start_trace("turn", session_id=sessions[0]) as root:
+        summarise_patient_report(general, patient, sessions[0])
+    checks = {"summary_turn_context": bool(turn_context(root))}
+
+    stage_ms: Dict[str, List[float]] = {}
+    for rec in turns:
+        for name, st in rec["stages"].items():
+            stage_ms.setdefault(name, []).append(st["ms"])
+
+    ingest_stages = ("parse_ms", "split_ms", "embed_ms", "upsert_ms", "total_ms")
+    return {
+        "commit": _git_commit(),
+        "config": {
+            "mode": args.mode, "concurrency": args.concurrency, "turns": len(work_items),
+            "llm_latency_ms": args.llm_latency_ms, "llm_concurrency": args.llm_concurrency,
+            "hash_embeddings": args.hash_embeddings, "embed_cache": args.embed_cache,
+            "reports": [r for r in (args.reports or ["<sample>"])], "work_dir": work,
+        },
+        "warmup_ms": round(warmup_ms, 1),
+        "ingest": {s: percentiles([r[s] for r in ingests]) for s in ingest_stages},
+        "helpbook_ingest": helpbook,
+        "turns": {
+            "completed": len(turns),
+            "failed": len(failures),
+            "errors": sorted(set(failures))[:10],
+            "wall_s": round(wall_s, 2),
+            "qps": round(len(turns) / wall_s, 2) if wall_s else 0.0,
+            "latency_ms": percentiles([r["duration_ms"] for r in turns]),
+            "stages_ms": {name: percentiles(v) for name, v in sorted(stage_ms.items())},
+        },
+        "peak_rss_mb": _peak_rss_mb(),
+        "checks": checks,
+    }
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Replay a question log against the RAG pipeline offline.")
+    ap.add_argument("--questions", help="question log (JSONL with 'question'/'q', or one question per line)")
+    ap.add_argument("--reports", nargs="*", default=[], help="patient report files (PDF/TXT); default: built-in sample")
+    ap.add_argument("--helpbook", help="optional helpbook PDF to ingest first")
+    ap.add_argument("--mode", choices=("rag", "tool", "agent"), default="rag",
+                    help="rag = answer_question, tool = RAG_QA tool (answer cache on), agent = full agent")
+    ap.add_argument("--concurrency", type=int, default=4, help="concurrent virtual users (one session each)")
+    ap.add_argument("--turns", type=int, default=0, help="questions to replay (default: the whole log once)")
+    ap.add_argument("--llm-latency-ms", type=float, default=200.0, help="stub LLM latency per call")
+    ap.add_argument("--llm-concurrency", type=int, default=8, help="LLM_MAX_CONCURRENCY")
+    ap.add_argument("--hash-embeddings", action="store_true", help="hashed bag-of-words instead of the transformer")
+    ap.add_argument("--embed-cache", action="store_true", help="use the on-disk embedding cache")
+    ap.add_argument("--work-dir", help="where the local index etc. are written (default: a temp dir)")
+    ap.add_argument("--out", help="write the JSON report here (default: stdout)")
+    args = ap.parse_args(argv)
+
+    result = run(args)
+    report = json.dumps(result, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+    failed = [name for name, ok in result["checks"].items() if not ok]
+    if failed:
+        sys.exit(f"bench checks failed: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
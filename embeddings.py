@@ -1,10 +1,392 @@
-# embeddings.py
+# ===========================================
+# file: embeddings.py
+# Shared, process-wide sentence-transformers embedding engine
+# ===========================================
 import os
+import json
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
 from dotenv import load_dotenv
+from langchain_core.embeddings import Embeddings
 from langchain_community.embeddings import HuggingFaceEmbeddings
 
+from resources import get_resource
+from tracing import span
+
 load_dotenv()
 
-def get_embeddings():
-    # 384-dimensional embedding model
-    return HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+# 384-dimensional embedding model
+EMBED_MODEL_NAME = os.getenv("EMBED_MODEL_NAME", "sentence-transformers/all-MiniLM-L6-v2")
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+
+# On-disk embedding cache (set EMBED_CACHE_DIR="" to disable)
+EMBED_CACHE_DIR = os.getenv("EMBED_CACHE_DIR", ".embed_cache")
+EMBED_CACHE_MAX_ENTRIES = int(os.getenv("EMBED_CACHE_MAX_ENTRIES", "50000"))
+
+# In-process LRU of query vectors (each distinct query is encoded once)
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "1024"))
+
+
+# ----------------------------
+# Content-addressed cache
+# ----------------------------
+def normalize_text(text: str) -> str:
+    # The tokenizer ignores whitespace runs, so collapsing them does not change the vector
+    return " ".join((text or "").split())
+
+
+def content_key(model_name: str, text: str) -> str:
+    return hashlib.sha256(f"{model_name}\n{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+# Cross-process advisory lock on a file in the cache directory
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+@contextmanager
+def _file_lock(path: str, shared: bool = False) -> Iterator[None]:
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)  # exclusive only
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class EmbeddingCache:
+    """
+    Fixed-capacity float32 vector cache on local disk, safe to share between processes.
+    - vectors live in one memory-mapped array: <dir>/<model>.f32, shape (capacity, dim)
+    - <dir>/<model>.log is append-only: a JSON header, then one "row key" line per
+      vector written (later lines win); each process replays what it has not seen yet
+    - writers hold <dir>/<model>.lock exclusively while picking rows, writing vectors
+      and appending; readers hold it shared, so a row is never read while reassigned
+    - when full, the least recently used row (as this process saw it) is overwritten;
+      the log is rewritten from the live rows once it reaches LOG_COMPACT_FACTOR x capacity lines
+    """
+
+    LOG_COMPACT_FACTOR = 4
+
+    def __init__(self, cache_dir: str, model_name: str, capacity: int = EMBED_CACHE_MAX_ENTRIES):
+        self.cache_dir = cache_dir
+        self.model_name = model_name
+        self.capacity = max(1, int(capacity))
+        slug = model_name.replace("/", "__")
+        self._vec_path = os.path.join(cache_dir, f"{slug}.f32")
+        self._log_path = os.path.join(cache_dir, f"{slug}.log")
+        self._lock_path = os.path.join(cache_dir, f"{slug}.lock")
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._slots: "OrderedDict[str, int]" = OrderedDict()  # key -> row, LRU first
+        self._owner: Dict[int, str] = {}  # row -> key last written there
+        self._dim: Optional[int] = None
+        self._arr: Optional[np.memmap] = None
+        self._log_id = None  # (st_dev, st_ino) of the log replayed so far
+        self._offset = 0
+        self._lines = 0
+        self._usable = False
+
+    def _apply(self, line: bytes):
+        if self._offset == 0 and not self._lines:
+            # Header: a cache built with another capacity/model is not reused
+            try:
+                meta = json.loads(line)
+                if meta.get("model") != self.model_name or int(meta.get("capacity", 0)) != self.capacity:
+                    return
+                self._dim = int(meta["dim"])
+                self._arr = np.memmap(self._vec_path, dtype=np.float32, mode="r+",
+                                      shape=(self.capacity, self._dim))
+                self._usable = True
+            except Exception:
+                pass  # corrupt/partial cache files are simply rebuilt
+            self._lines = 1
+            return
+        self._lines += 1
+        if not self._usable:
+            return
+        slot_s, key = line.decode("ascii").split(" ", 1)
+        slot = int(slot_s)
+        prev = self._owner.get(slot)
+        if prev is not None and self._slots.get(prev) == slot:
+            del self._slots[prev]
+        self._owner[slot] = key
+        self._slots[key] = slot
+        self._slots.move_to_end(key)
+
+    def _sync(self, writer: bool) -> bool:
+        """Replay log lines written since the last call (by any process). True if the cache is usable."""
+        try:
+            st = os.stat(self._log_path)
+        except FileNotFoundError:
+            self._reset()
+            return False
+        if (st.st_dev, st.st_ino) != self._log_id:
+            # New or compacted log: start over from its header
+            self._reset()
+            self._log_id = (st.st_dev, st.st_ino)
+        if st.st_size > self._offset:
+            with open(self._log_path, "rb") as f:
+                f.seek(self._offset)
+                data = f.read()
+            end = data.rfind(b"\n") + 1  # complete lines only
+            for line in data[:end].splitlines():
+                self._apply(line)
+                self._offset += len(line) + 1
+            if writer and end < len(data):
+                # A writer died mid-line: cut it off before appending after it
+                with open(self._log_path, "r+b") as f:
+                    f.truncate(self._offset)
+        return self._usable
+
+    def _write_log(self, lines: List[str]):
+        """Replace the log with a header + `lines` (new cache or compaction)."""
+        tmp = self._log_path + ".tmp"
+        with open(tmp, "w", encoding="ascii", newline="\n") as f:
+            f.write(json.dumps({"model": self.model_name, "dim": self._dim, "capacity": self.capacity}) + "\n")
+            f.writelines(lines)
+        os.replace(tmp, self._log_path)
+        st = os.stat(self._log_path)
+        self._log_id = (st.st_dev, st.st_ino)
+        self._offset = st.st_size
+        self._lines = 1 + len(lines)
+
+    def _create(self, dim: int):
+        self._reset()
+        self._dim = dim
+        tmp = self._vec_path + ".tmp"
+        np.memmap(tmp, dtype=np.float32, mode="w+", shape=(self.capacity, dim)).flush()
+        os.replace(tmp, self._vec_path)
+        self._arr = np.memmap(self._vec_path, dtype=np.float32, mode="r+", shape=(self.capacity, dim))
+        self._usable = True
+        self._write_log([])
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        hits: Dict[str, List[float]] = {}
+        if not os.path.exists(self._log_path):
+            return hits
+        with self._lock, _file_lock(self._lock_path, shared=True):
+            if not self._sync(writer=False):
+                return hits
+            for k in keys:
+                slot = self._slots.get(k)
+                if slot is not None:
+                    self._slots.move_to_end(k)
+                    hits[k] = self._arr[slot].tolist()
+        return hits
+
+    def put_many(self, items: Dict[str, List[float]]):
+        if not items:
+            return
+        dim = len(next(iter(items.values())))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with self._lock, _file_lock(self._lock_path):
+            if not self._sync(writer=True) or self._dim != dim:
+                self._create(dim)
+            lines = []
+            try:
+                for k, vec in items.items():
+                    slot = self._slots.get(k)
+                    if slot is None:
+                        if len(self._owner) < self.capacity:
+                            slot = len(self._owner)  # rows are handed out in order, never freed
+                        else:
+                            _, slot = self._slots.popitem(last=False)  # evict LRU row
+                    self._arr[slot] = np.asarray(vec, dtype=np.float32)
+                    lines.append(f"{slot} {k}\n")
+                    self._apply(lines[-1][:-1].encode("ascii"))
+                # Vectors reach the file before the log line that points at them
+                self._arr.flush()
+                data = "".join(lines).encode("ascii")
+                with open(self._log_path, "ab") as f:
+                    f.write(data)
+                self._offset += len(data)
+            except BaseException:
+                self._reset()  # replay from the log next time
+                raise
+            if self._lines > self.LOG_COMPACT_FACTOR * self.capacity:
+                self._write_log([f"{slot} {k}\n" for k, slot in self._slots.items()])
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+
+# Per-call hit/miss counters (e.g. one ingest run), isolated per thread/task
+_cache_counter: ContextVar[Optional[Dict[str, int]]] = ContextVar("embed_cache_counter", default=None)
+
+
+@contextmanager
+def track_cache() -> Iterator[Dict[str, int]]:
+    """
+    Count embedding-cache hits/misses for everything embedded inside the block:
+        with track_cache() as c:
+            idx.add_documents(chunks)
+        c["hits"], c["misses"]
+    """
+    counter = {"hits": 0, "misses": 0}
+    token = _cache_counter.set(counter)
+    try:
+        yield counter
+    finally:
+        _cache_counter.reset(token)
+
+
+class EmbeddingEngine(Embeddings):
+    """
+    One shared embedding model per process.
+    - Loads weights once (lazily, or up front via warmup())
+    - Serialises access to the model so it is safe to share across threads
+    - Encodes documents in fixed-size batches
+    - Keeps load/encode timings for the metrics panel
+    """
+
+    def __init__(self, model_name: str = EMBED_MODEL_NAME, batch_size: int = EMBED_BATCH_SIZE,
+                 cache_dir: Optional[str] = EMBED_CACHE_DIR):
+        self.model_name = model_name
+        self.batch_size = max(1, int(batch_size))
+        self.cache = EmbeddingCache(cache_dir, model_name) if cache_dir else None
+        self._queries: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._query_lock = threading.Lock()
+        self._model: Optional[HuggingFaceEmbeddings] = None
+        self._load_lock = threading.Lock()
+        self._encode_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "load_ms": 0.0,
+            "encode_calls": 0,
+            "texts_encoded": 0,
+            "encode_ms_total": 0.0,
+            "last_encode_ms": 0.0,
+            "cache_hits": 0,
+            "cache_misses": 0,
+            "query_cache_hits": 0,
+            "query_cache_misses": 0,
+        }
+
+    # Load the transformer weights exactly once
+    def _get_model(self) -> HuggingFaceEmbeddings:
+        if self._model is None:
+            with self._load_lock:
+                if self._model is None:
+                    t0 = time.perf_counter()
+                    self._model = HuggingFaceEmbeddings(
+                        model_name=self.model_name,
+                        encode_kwargs={"batch_size": self.batch_size},
+                    )
+                    self._stats["load_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        return self._model
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        model = self._get_model()
+        t0 = time.perf_counter()
+        out: List[List[float]] = []
+        with self._encode_lock:
+            for i in range(0, len(texts), self.batch_size):
+                out.extend(model.embed_documents(texts[i:i + self.batch_size]))
+            ms = (time.perf_counter() - t0) * 1000
+            self._stats["encode_calls"] += 1
+            self._stats["texts_encoded"] += len(texts)
+            self._stats["encode_ms_total"] = round(self._stats["encode_ms_total"] + ms, 1)
+            self._stats["last_encode_ms"] = round(ms, 1)
+        return out
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        with span("embed.documents", kind="embedding", texts=len(texts)) as sp:
+            vectors, hits = self._embed_documents(list(texts))
+            sp.set(cache_hits=hits)
+            return vectors
+
+    def _embed_documents(self, texts: List[str]):
+        if self.cache is None:
+            return self._encode(texts), 0
+
+        # Look every chunk up by content key; only misses reach the transformer
+        keys = [content_key(self.model_name, t) for t in texts]
+        found = self.cache.get_many(keys)
+        todo: Dict[str, str] = {}
+        for k, t in zip(keys, texts):
+            if k not in found and k not in todo:
+                todo[k] = t
+        if todo:
+            fresh = dict(zip(todo.keys(), self._encode(list(todo.values()))))
+            self.cache.put_many(fresh)
+            found.update(fresh)
+
+        hits = sum(1 for k in keys if k not in todo)
+        misses = len(keys) - hits
+        with self._stats_lock:
+            self._stats["cache_hits"] += hits
+            self._stats["cache_misses"] += misses
+        counter = _cache_counter.get()
+        if counter is not None:
+            counter["hits"] += hits
+            counter["misses"] += misses
+        return [found[k] for k in keys], hits
+
+    def embed_query(self, text: str) -> List[float]:
+        with span("embed.query", kind="embedding") as sp:
+            vec, hit = self._embed_query(text)
+            sp.set(cache_hit=hit)
+            return vec
+
+    def _embed_query(self, text: str):
+        key = normalize_text(text)
+        with self._query_lock:
+            vec = self._queries.get(key)
+            if vec is not None:
+                self._queries.move_to_end(key)
+                self._stats["query_cache_hits"] += 1
+                return vec, True
+
+        vec = self._encode([text])[0]
+        with self._query_lock:
+            self._stats["query_cache_misses"] += 1
+            self._queries[key] = vec
+            self._queries.move_to_end(key)
+            while len(self._queries) > QUERY_CACHE_SIZE:
+                self._queries.popitem(last=False)
+        return vec, False
+
+    def warmup(self) -> Dict[str, object]:
+        """Load the model and run one tiny encode so the first real request is not cold."""
+        self._encode(["warmup"])
+        return self.stats()
+
+    def stats(self) -> Dict[str, object]:
+        return dict(self._stats, model_name=self.model_name, batch_size=self.batch_size,
+                    cache_entries=len(self.cache) if self.cache is not None else 0)
+
+
+def get_embeddings() -> EmbeddingEngine:
+    # Shared engine: every caller gets the same loaded model
+    return get_resource("embeddings", EmbeddingEngine)
+
+
+def warmup() -> Dict[str, object]:
+    return get_embeddings().warmup()
+
+
+def get_embedding_stats() -> Dict[str, object]:
+    return get_embeddings().stats()
@@ -0,0 +1,89 @@
+# ===========================================
+# file: helpbook_manifest.py
+# Versioned manifest of helpbook pages (per-page hashes -> chunk ids)
+# ===========================================
+import os
+import json
+import copy
+import threading
+from typing import Dict, List, Optional
+
+# One JSON manifest per general index
+HELPBOOK_MANIFEST_DIR = os.getenv("HELPBOOK_MANIFEST_DIR", ".helpbook_manifest")
+
+# hb_to value of chunks that are still live
+HB_OPEN = 1_000_000_000
+
+# Every helpbook chunk carries hb_from / hb_to metadata: it is visible to queries
+# at version v when hb_from <= v < hb_to. Bumping the manifest version is therefore
+# the atomic switch: chunks written for the next version stay hidden until then, and
+# chunks retired by it (hb_to = next version) disappear at the same moment.
+
+_lock = threading.Lock()
+# index -> (file mtime, manifest)
+_cache: Dict[str, tuple] = {}
+
+
+def _path(index_name: str) -> str:
+    return os.path.join(HELPBOOK_MANIFEST_DIR, f"{index_name}.json")
+
+
+def _empty() -> dict:
+    # sources: source name -> {"version": v, "pages": {page: {"hash": h, "chunks": [ids]}}}
+    return {"version": 0, "sources": {}}
+
+
+def _read(index_name: str) -> dict:
+    """Cached manifest, reloaded when another process replaced the file."""
+    path = _path(index_name)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return _empty()
+    with _lock:
+        hit = _cache.get(index_name)
+        if hit and hit[0] == mtime:
+            return hit[1]
+    with open(path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    with _lock:
+        _cache[index_name] = (mtime, manifest)
+    return manifest
+
+
+def load(index_name: str) -> dict:
+    return copy.deepcopy(_read(index_name))
+
+
+def current_version(index_name: str) -> int:
+    return int(_read(index_name)["version"])
+
+
+def version_filter(index_name: str) -> Optional[dict]:
+    """Metadata filter for the live helpbook version (None before the first versioned ingest)."""
+    v = current_version(index_name)
+    if not v:
+        return None
+    return {"hb_from": {"$lte": v}, "hb_to": {"$gt": v}}
+
+
+def chunk_ids(source_entry: Optional[dict]) -> List[str]:
+    ids: List[str] = []
+    for page in (source_entry or {}).get("pages", {}).values():
+        ids.extend(page["chunks"])
+    return ids
+
+
+def commit(index_name: str, source: str, pages: Dict[str, dict], version: int):
+    """Record the new page table for `source` and switch queries to `version`."""
+    manifest = load(index_name)
+    manifest["version"] = version
+    manifest["sources"][source] = {"version": version, "pages": pages}
+    os.makedirs(HELPBOOK_MANIFEST_DIR, exist_ok=True)
+    path = _path(index_name)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, path)  # the switch: readers see either the old or the new version
+    with _lock:
+        _cache.pop(index_name, None)
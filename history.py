@@ -0,0 +1,174 @@
+# ===========================================
+# file: history.py
+# Chat history store (bounded memory tier + optional SQLite tier)
+# ===========================================
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Sequence
+
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+
+from resources import get_resource
+
+# "memory" (default) or "sqlite" (survives restarts, shared by worker processes)
+HISTORY_BACKEND = os.getenv("HISTORY_BACKEND", "memory").lower()
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH", "chat_history.sqlite3")
+# Memory tier bounds: sessions kept hot, and how long an idle one stays
+HISTORY_MAX_SESSIONS = int(os.getenv("HISTORY_MAX_SESSIONS", "1000"))
+HISTORY_TTL_S = float(os.getenv("HISTORY_TTL_S", "7200"))
+# Messages retained per session, and the share of the prompt history may take
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", "200"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English text; good enough for budgeting
+    return max(1, len(text or "") // 4)
+
+
+def history_window(messages: Sequence[BaseMessage], budget: int = HISTORY_TOKEN_BUDGET) -> List[BaseMessage]:
+    """
+    Most recent messages that fit in `budget` tokens, oldest first. Keeps the
+    prompt the same size however long the conversation gets.
+    """
+    out: List[BaseMessage] = []
+    used = 0
+    for m in reversed(messages):
+        cost = estimate_tokens(str(m.content))
+        if used + cost > budget:
+            break
+        out.append(m)
+        used += cost
+    out.reverse()
+    return out
+
+
+class _SQLiteTier:
+    """Messages table shared by every session; one connection per process."""
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " session_id TEXT NOT NULL,"
+                " message TEXT NOT NULL,"
+                " created_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS messages_session ON messages (session_id, id)")
+
+    def load(self, session_id: str, limit: int) -> List[BaseMessage]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT message FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+                (session_id, limit),
+            ).fetchall()
+        return messages_from_dict([json.loads(r[0]) for r in reversed(rows)])
+
+    def append(self, session_id: str, messages: Sequence[BaseMessage], keep: int):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO messages (session_id, message, created_at) VALUES (?, ?, ?)",
+                [(session_id, json.dumps(message_to_dict(m)), now) for m in messages],
+            )
+            # Retention: only the newest `keep` messages per session
+            self._conn.execute(
+                "DELETE FROM messages WHERE session_id = ? AND id NOT IN "
+                "(SELECT id FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?)",
+                (session_id, session_id, keep),
+            )
+
+    def clear(self, session_id: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+
+
+class SessionHistory(BaseChatMessageHistory):
+    """One session's messages: kept in memory, written through to SQLite when enabled."""
+
+    def __init__(self, session_id: str, tier: Optional[_SQLiteTier] = None,
+                 max_messages: int = HISTORY_MAX_MESSAGES):
+        self.session_id = session_id
+        self._tier = tier
+        self._max = max_messages
+        self._lock = threading.Lock()
+        self._messages: List[BaseMessage] = tier.load(session_id, max_messages) if tier else []
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        with self._lock:
+            return list(self._messages)
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        with self._lock:
+            self._messages.extend(messages)
+            del self._messages[:-self._max]
+            if self._tier is not None:
+                self._tier.append(self.session_id, messages, self._max)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._messages = []
+            if self._tier is not None:
+                self._tier.clear(self.session_id)
+
+
+class HistoryStore:
+    """
+    LRU/TTL-bounded map of session_id -> SessionHistory. With the SQLite tier,
+    evicting a session only drops the cached copy; it is reloaded on next use.
+    """
+
+    def __init__(self, backend: str = HISTORY_BACKEND, db_path: str = HISTORY_DB_PATH,
+                 max_sessions: int = HISTORY_MAX_SESSIONS, ttl_s: float = HISTORY_TTL_S):
+        if backend not in ("memory", "sqlite"):
+            raise RuntimeError(f"Unknown HISTORY_BACKEND '{backend}' (use 'memory' or 'sqlite')")
+        self._tier = _SQLiteTier(db_path) if backend == "sqlite" else None
+        self.max_sessions = max_sessions
+        self.ttl_s = ttl_s
+        self._lock = threading.Lock()
+        # session_id -> (history, last used), least recently used first
+        self._hot: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def _evict(self, now: float):
+        while self._hot:
+            sid, (_, used) = next(iter(self._hot.items()))
+            if len(self._hot) <= self.max_sessions and now - used <= self.ttl_s:
+                break
+            self._hot.pop(sid)
+
+    def get(self, session_id: str) -> SessionHistory:
+        now = time.monotonic()
+        with self._lock:
+            hit = self._hot.pop(session_id, None)
+            hist = hit[0] if hit and now - hit[1] <= self.ttl_s else None
+            if hist is None:
+                hist = SessionHistory(session_id, self._tier)
+            self._hot[session_id] = (hist, now)
+            self._evict(now)
+            return hist
+
+    def clear(self, session_id: str):
+        with self._lock:
+            hit = self._hot.pop(session_id, None)
+        if hit:
+            hit[0].clear()
+        elif self._tier is not None:
+            self._tier.clear(session_id)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._hot)
+
+
+def get_history_store() -> HistoryStore:
+    return get_resource("history_store", HistoryStore)
@@ -2,71 +2,93 @@
 # file: ingest.py
 # Load & chunk PDFs/TXT and upsert to Pinecone
 # ===========================================
-from typing import List, BinaryIO
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, BinaryIO
+import io
 import os
-import uuid
-import tempfile
-
+import time
+import queue
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import (
+    FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait,
+)
+from concurrent.futures.process import BrokenProcessPool
+
+from pypdf import PdfReader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import PyPDFLoader
 from langchain_core.documents import Document
 
-from vectorstore import get_vectorstore
+from vectorstore import (
+    get_vectorstore, session_namespace, upsert_vectors, fetch_metadata, update_metadata, session_vector_count,
+)
+from embeddings import get_embeddings, normalize_text, track_cache
+from resources import get_resource, drop_resource
+from janitor import touch_session
+import answer_cache
+import helpbook_manifest
+import labs
+import trace_export
+from rag_tools import start_summary_job
+
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "64"))    # chunks per embed + upsert call
+INGEST_MAX_PENDING = int(os.getenv("INGEST_MAX_PENDING", "4"))   # chunk batches parsed ahead of the embedder
+INGEST_PARSE_WORKERS = int(os.getenv("INGEST_PARSE_WORKERS", str(min(4, os.cpu_count() or 1))))  # processes
+INGEST_UPSERT_WORKERS = int(os.getenv("INGEST_UPSERT_WORKERS", "4"))  # concurrent upsert requests
+
+# progress(pages_done, total_pages, chunks_processed)
+ProgressFn = Callable[[int, int, int], None]
 
 
 # ----------------------------
 # Chunking
 # ----------------------------
+_splitter = RecursiveCharacterTextSplitter(
+    chunk_size=1000,
+    chunk_overlap=150,
+    separators=["\n\n", "\n", " ", ""],
+)
+
 def _split_docs(docs: List[Document]) -> List[Document]:
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=150,
-        separators=["\n\n", "\n", " ", ""],
-    )
-    return splitter.split_documents(docs)
+    return _splitter.split_documents(docs)
+
+
+def chunk_id(source: str, text: str) -> str:
+    """
+    Vector id = hash of where the chunk comes from + what it says. Re-ingesting the
+    same content yields the same ids, so the store is overwritten instead of duplicated.
+    """
+    return hashlib.sha256(f"{source}\n{normalize_text(text)}".encode("utf-8")).hexdigest()[:32]
 
 
 # ----------------------------
-# Loaders (Windows/Cloud-safe)
+# Loaders (in-memory, no temp files)
 # ----------------------------
-def _load_pdf(file: BinaryIO, source_name: str) -> List[Document]:
+def _pdf_reader(file: BinaryIO) -> PdfReader:
     """
-    Writes the uploaded file to a *real* temp file (portable),
-    parses with PyPDFLoader, and attaches basic metadata.
+    Opens the upload straight from memory. Streamlit's UploadedFile is already a
+    seekable BytesIO, so pypdf reads it in place; other objects are wrapped once.
     """
-    # Create an actual temp file path; close the OS handle right away
-    fd, tmp_path = tempfile.mkstemp(suffix=".pdf")
-    os.close(fd)
-
     try:
-        # Reset pointer if supported
-        try:
-            file.seek(0)
-        except Exception:
-            pass
-
-        # Write bytes (supports Streamlit's UploadedFile)
-        with open(tmp_path, "wb") as out:
-            try:
-                out.write(file.getbuffer())
-            except AttributeError:
-                out.write(file.read())
+        file.seek(0)
+    except Exception:
+        pass
+    if hasattr(file, "seek") and hasattr(file, "read"):
+        return PdfReader(file)
+    return PdfReader(io.BytesIO(file.read()))
 
-        loader = PyPDFLoader(tmp_path)
-        docs = loader.load()  # one Document per page
 
-        for d in docs:
-            d.metadata = d.metadata or {}
-            d.metadata["source"] = source_name
+def _iter_pdf_pages(reader: PdfReader, source_name: str) -> Iterator[Document]:
+    """Yields one Document per page, extracting text lazily (same metadata as PyPDFLoader)."""
+    for i, page in enumerate(reader.pages):
+        yield Document(page_content=page.extract_text() or "", metadata={"source": source_name, "page": i})
 
-        return docs
 
-    finally:
-        # Always clean up the temp file
-        try:
-            os.remove(tmp_path)
-        except OSError:
-            pass
+def _load_pdf(file: BinaryIO, source_name: str) -> List[Document]:
+    """
+    Parses an uploaded PDF from memory and attaches basic metadata.
+    """
+    return list(_iter_pdf_pages(_pdf_reader(file), source_name))
 
 
 def _load_txt(file: BinaryIO, source_name: str) -> List[Document]:
@@ -90,111 +112,417 @@ def _load_txt(file: BinaryIO, source_name: str) -> List[Document]:
 
 
 # ----------------------------
-# Public ingest functions
+# Pipeline: parse -> split -> embed -> upsert
 # ----------------------------
-def ingest_helpbook_pdf(uploaded_file, general_index_name: str) -> int:
+_STAGES = ("parse", "split", "embed", "upsert")
+
+
+def _new_stats() -> Dict[str, float]:
+    stats = {f"{s}_ms": 0.0 for s in _STAGES}
+    stats.update(pages=0, new=0, updated=0, skipped=0)
+    return stats
+
+
+def _result(chunks: int, cache: Optional[Dict[str, int]] = None,
+            stats: Optional[Dict[str, float]] = None, total_ms: float = 0.0) -> Dict[str, float]:
     """
-    - Saves uploaded PDF to a temp path (Windows/Cloud-safe)
-    - Parses with PyPDFLoader
-    - Adds minimal metadata
-    - Splits and upserts into your vectorstore
-    Returns: number of chunks upserted.
+    Ingest summary. Stage *_ms values are busy time summed over workers, so with
+    the pipeline overlapping they can add up to more than total_ms (wall clock).
+    chunks = new (embedded + upserted) + updated (metadata only) + skipped (already stored).
     """
-    idx = get_vectorstore(general_index_name)
+    cache = cache or {}
+    stats = stats or _new_stats()
+    secs = total_ms / 1000.0
+    out = {
+        "chunks": chunks,
+        "embed_cache_hits": cache.get("hits", 0),
+        "embed_cache_misses": cache.get("misses", 0),
+        "new": stats["new"],
+        "updated": stats["updated"],
+        "skipped": stats["skipped"],
+        "pages": stats["pages"],
+    }
+    for s in _STAGES:
+        out[f"{s}_ms"] = round(stats[f"{s}_ms"], 1)
+    out["total_ms"] = round(total_ms, 1)
+    out["pages_per_s"] = round(stats["pages"] / secs, 2) if secs else 0.0
+    out["chunks_per_s"] = round(chunks / secs, 2) if secs else 0.0
+    return out
+
+
+def _timed_pages(pages: Iterator[Document], stats: Dict[str, float]) -> Iterator[Document]:
+    """Charge the time spent producing each page (lazy PDF text extraction) to the parse stage."""
+    it = iter(pages)
+    while True:
+        t0 = time.perf_counter()
+        try:
+            page = next(it)
+        except StopIteration:
+            return
+        stats["parse_ms"] += (time.perf_counter() - t0) * 1000
+        stats["pages"] += 1
+        yield page
+
+
+def _chunk_batches(pages: Iterator[Document], batch_size: int,
+                   stats: Dict[str, float]) -> Iterator[Tuple[List[Document], int]]:
+    """Split pages as they arrive and emit (chunk batch, pages consumed so far)."""
+    buf: List[Document] = []
+    pages_done = 0
+    for page in pages:
+        pages_done += 1
+        t0 = time.perf_counter()
+        buf.extend(_split_docs([page]))
+        stats["split_ms"] += (time.perf_counter() - t0) * 1000
+        while len(buf) >= batch_size:
+            yield buf[:batch_size], pages_done
+            buf = buf[batch_size:]
+    if buf:
+        yield buf, pages_done
+
+
+def _upsert_pool() -> ThreadPoolExecutor:
+    return get_resource(
+        "ingest_upsert_pool",
+        lambda: ThreadPoolExecutor(max_workers=INGEST_UPSERT_WORKERS, thread_name_prefix="ingest-upsert"),
+    )
 
-    # 1) Write to temp, parse
-    fd, tmp_path = tempfile.mkstemp(suffix=".pdf")
-    os.close(fd)
 
-    try:
-        try:
-            uploaded_file.seek(0)
-        except Exception:
-            pass
+def _store_call(fn: Callable, *args, **kwargs) -> float:
+    t0 = time.perf_counter()
+    fn(*args, **kwargs)
+    return (time.perf_counter() - t0) * 1000
 
-        with open(tmp_path, "wb") as f:
-            try:
-                f.write(uploaded_file.getbuffer())
-            except AttributeError:
-                f.write(uploaded_file.read())
-
-        loader = PyPDFLoader(tmp_path)
-        docs = loader.load()
-
-        # 2) Attach metadata
-        src_name = getattr(uploaded_file, "name", "uploaded.pdf")
-        batch_id = uuid.uuid4().hex[:8]
-        for i, d in enumerate(docs):
-            d.metadata = d.metadata or {}
-            d.metadata.update(
-                {
-                    "source": src_name,
-                    "batch_id": batch_id,
-                    "page": d.metadata.get("page", i),
-                    "kind": "helpbook",
-                }
-            )
-
-        # 3) Split
-        chunks = _split_docs(docs)
-        if not chunks:
-            return 0
-
-        # 4) Stable IDs to avoid dupes on re-ingest
-        for j, c in enumerate(chunks):
-            c.metadata = c.metadata or {}
-            c.metadata.setdefault("id", f"{batch_id}-{j}")
-
-        # 5) Upsert
-        idx.add_documents(chunks)
-        return len(chunks)
 
-    finally:
-        try:
-            os.remove(tmp_path)
-        except OSError:
-            pass
+_DONE = object()
 
-# ingest patient files
-def ingest_patient_files(files, patient_index_name: str, session_id: str) -> int:
+def _pipelined_upsert(
+    index_name: str,
+    namespace: Optional[str],
+    batches: Iterator[Tuple[List[Document], int]],
+    on_batch: Callable[[List[Document], int], None],
+    stats: Dict[str, float],
+    keep_stored: Tuple[str, ...] = (),
+) -> None:
     """
-    Load one or more patient files and embed into the PATIENT index with session metadata.
-    Returns: number of chunks upserted.
+    Three overlapping stages:
+    - parse/split runs on a producer thread; the queue holds at most INGEST_MAX_PENDING
+      batches, so the parser waits (backpressure) instead of piling everything up in memory
+    - this thread embeds each batch (the model is shared and serialised anyway)
+    - upserts go to a thread pool, with at most INGEST_UPSERT_WORKERS requests in flight
+    Chunks get content-hash ids (chunk_id) and each batch is checked against the store
+    first: unchanged chunks are skipped, metadata-only changes are patched in place, and
+    only new content is embedded and upserted. Metadata keys in `keep_stored` keep
+    their stored value for chunks that already exist.
     """
-    # Get pinecone vector store
-    idx = get_vectorstore(patient_index_name)
-    all_chunks: List[Document] = []
+    q: "queue.Queue" = queue.Queue(maxsize=INGEST_MAX_PENDING)
+    stop = threading.Event()
+
+    def _put(item) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce():
+        try:
+            for item in batches:
+                if not _put(item):
+                    return
+            _put(_DONE)
+        except BaseException as e:
+            _put(e)
+
+    def _collect(done):
+        for fut in done:
+            stats["upsert_ms"] += fut.result()  # re-raises upsert errors here
+
+    def _submit(fn, *args, **kwargs):
+        nonlocal pending
+        while len(pending) >= INGEST_UPSERT_WORKERS:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            _collect(done)
+        pending.add(pool.submit(_store_call, fn, *args, **kwargs))
+
+    emb = get_embeddings()
+    pool = _upsert_pool()
+    pending = set()
+    seen = set()  # ids already handled in this run (repeated boilerplate chunks)
+    producer = threading.Thread(target=_produce, name="ingest-parse", daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = q.get()
+            if item is _DONE:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            chunks, pages_done = item
+            for c in chunks:
+                c.metadata["id"] = chunk_id(c.metadata.get("source", ""), c.page_content)
+            on_batch(chunks, pages_done)
+
+            batch: Dict[str, Document] = {}
+            for c in chunks:
+                cid = c.metadata["id"]
+                if cid in seen:
+                    stats["skipped"] += 1
+                else:
+                    seen.add(cid)
+                    batch[cid] = c
+            if not batch:
+                continue
+
+            # One lookup per batch: what is already stored under these ids?
+            t0 = time.perf_counter()
+            stored = fetch_metadata(index_name, list(batch), namespace=namespace)
+            stats["upsert_ms"] += (time.perf_counter() - t0) * 1000
+            fresh: List[Document] = []
+            moved: Dict[str, dict] = {}
+            for cid, c in batch.items():
+                if cid in stored:
+                    c.metadata.update({k: stored[cid][k] for k in keep_stored if k in stored[cid]})
+                if cid not in stored:
+                    fresh.append(c)
+                elif stored[cid] != c.metadata:
+                    moved[cid] = dict(c.metadata)
+                else:
+                    stats["skipped"] += 1
+            stats["new"] += len(fresh)
+            stats["updated"] += len(moved)
+
+            # Same text, different metadata (e.g. page moved): no re-embedding needed
+            if moved:
+                _submit(update_metadata, index_name, moved, namespace=namespace)
+            if fresh:
+                texts = [c.page_content for c in fresh]
+                t0 = time.perf_counter()
+                vectors = emb.embed_documents(texts)  # cached by content
+                stats["embed_ms"] += (time.perf_counter() - t0) * 1000
+                _submit(upsert_vectors, index_name, [c.metadata["id"] for c in fresh], vectors,
+                        texts, [dict(c.metadata) for c in fresh], namespace=namespace)
+        _collect(wait(pending).done)
+    finally:
+        stop.set()
 
-    for f in files:
-        name = getattr(f, "name", "patient_upload")
-        src = f"patient_{name}"
 
-        if name.lower().endswith(".pdf"):
-            docs = _load_pdf(f, source_name=src)
-        else:
-            docs = _load_txt(f, source_name=src)
+# Process-pool worker (module level so it can be pickled)
+def _parse_upload(name: str, data: bytes) -> Tuple[str, List[Document], float]:
+    """Parse one uploaded file from its bytes. Returns (source name, page docs, parse ms)."""
+    t0 = time.perf_counter()
+    src = f"patient_{name}"
+    buf = io.BytesIO(data)
+    if name.lower().endswith(".pdf"):
+        docs = _load_pdf(buf, source_name=src)
+    else:
+        docs = _load_txt(buf, source_name=src)
+    return src, docs, (time.perf_counter() - t0) * 1000
 
-        # Tag page docs with session info
-        for d in docs:
-            d.metadata = d.metadata or {}
-            d.metadata["session_id"] = session_id
-            d.metadata["kind"] = "patient"
-            d.metadata.setdefault("source", src)
 
-        # Split and propagate metadata
-        chunks = _split_docs(docs)
-        batch_id = uuid.uuid4().hex[:8]
+def _file_bytes(file: BinaryIO) -> bytes:
+    if hasattr(file, "getvalue"):
+        return file.getvalue()
+    try:
+        file.seek(0)
+    except Exception:
+        pass
+    return file.read()
 
-        for j, c in enumerate(chunks):
-            c.metadata = c.metadata or {}
-            c.metadata.setdefault("session_id", session_id)
-            c.metadata.setdefault("kind", "patient")
-            c.metadata.setdefault("source", src)
-            c.metadata.setdefault("id", f"{batch_id}-{j}")
 
-        all_chunks.extend(chunks)
+def _parse_pool() -> ProcessPoolExecutor:
+    # Never fork: Streamlit/torch threads may hold locks the forked child would inherit
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return get_resource("ingest_parse_pool", lambda: ProcessPoolExecutor(
+        max_workers=INGEST_PARSE_WORKERS, mp_context=multiprocessing.get_context(method),
+    ))
 
-    if all_chunks:
-        idx.add_documents(all_chunks)
 
-    return len(all_chunks)
+def _iter_parsed(files) -> Iterator[Tuple[str, List[Document], float]]:
+    """
+    Parse uploads in the process pool (PDF text extraction is CPU-bound) and yield
+    each file as soon as it is done. A single file, or INGEST_PARSE_WORKERS <= 1,
+    is parsed in-process since the pool round trip would cost more than it saves.
+    """
+    jobs = [(getattr(f, "name", "patient_upload"), _file_bytes(f)) for f in files]
+    if INGEST_PARSE_WORKERS <= 1 or len(jobs) <= 1:
+        for name, data in jobs:
+            yield _parse_upload(name, data)
+        return
+    try:
+        futs = [_parse_pool().submit(_parse_upload, name, data) for name, data in jobs]
+        for fut in as_completed(futs):
+            yield fut.result()
+    except BrokenProcessPool:
+        # A worker died: the next ingest gets a fresh pool
+        drop_resource("ingest_parse_pool")
+        raise
+
+
+# ----------------------------
+# Public ingest functions
+# ----------------------------
+def _retire_chunks(index_name: str, ids: List[str], version: int, batch_size: int = 100):
+    """Mark chunks as gone from `version` on (hb_to); they stay visible to older versions."""
+    for i in range(0, len(ids), batch_size):
+        stored = fetch_metadata(index_name, ids[i:i + batch_size])
+        for meta in stored.values():
+            meta["hb_to"] = version
+        if stored:
+            update_metadata(index_name, stored)
+
+
+def ingest_helpbook_pdf(
+    uploaded_file,
+    general_index_name: str,
+    on_progress: Optional[ProgressFn] = None,
+    batch_size: int = INGEST_BATCH_SIZE,
+) -> Dict[str, float]:
+    """
+    Incremental, streaming helpbook ingest:
+    - Reads the uploaded PDF from memory (no temp file)
+    - Compares each page's hash with the helpbook manifest; unchanged pages are not
+      split, embedded or upserted at all
+    - Changed/new pages are split as they arrive, embedded in batches of `batch_size`
+      chunks and upserted concurrently (chunks already stored are skipped)
+    - Chunks that no longer exist are retired, the manifest version is bumped (queries
+      switch to the new version in one step), then the retired vectors are deleted
+    - Calls on_progress(pages_done, total_pages, chunks_processed) after each batch
+    Returns chunk count, embed cache hits/misses, per-stage timings and throughput (see _result),
+    plus pages_unchanged, removed and the live helpbook version.
+    """
+    t_start = time.perf_counter()
+    stats = _new_stats()
+    reader = _pdf_reader(uploaded_file)
+    total_pages = len(reader.pages)
+
+    src_name = getattr(uploaded_file, "name", "uploaded.pdf")
+    manifest = helpbook_manifest.load(general_index_name)
+    old_pages = manifest["sources"].get(src_name, {}).get("pages", {})
+    version = manifest["version"] + 1
+    pages: Dict[str, dict] = {}  # new page table for the manifest
+    pages_unchanged = 0
+    processed = 0
+
+    # Hash every page; only changed ones go down the pipeline
+    def _pages() -> Iterator[Document]:
+        nonlocal pages_unchanged
+        for d in _timed_pages(_iter_pdf_pages(reader, src_name), stats):
+            key = str(d.metadata["page"])
+            h = hashlib.sha256(normalize_text(d.page_content).encode("utf-8")).hexdigest()
+            old = old_pages.get(key)
+            if old and old["hash"] == h:
+                pages[key] = old
+                pages_unchanged += 1
+                continue
+            pages[key] = {"hash": h, "chunks": []}
+            # Hidden from queries until the manifest switches to `version`
+            d.metadata.update({"kind": "helpbook", "hb_from": version, "hb_to": helpbook_manifest.HB_OPEN})
+            yield d
+
+    def _on_batch(chunks: List[Document], pages_done: int):
+        nonlocal processed
+        for c in chunks:
+            pages[str(c.metadata["page"])]["chunks"].append(c.metadata["id"])
+        processed += len(chunks)
+        if on_progress:
+            on_progress(stats["pages"], total_pages, processed)
+
+    with track_cache() as cache:
+        batches = _chunk_batches(_pages(), batch_size, stats)
+        # Chunks already stored keep their hb_from, so they stay visible until the switch
+        _pipelined_upsert(general_index_name, None, batches, _on_batch, stats, keep_stored=("hb_from",))
+
+    # Chunks of the old version that the new one no longer has
+    live = {cid for p in pages.values() for cid in p["chunks"]}
+    removed = [cid for cid in helpbook_manifest.chunk_ids({"pages": old_pages}) if cid not in live]
+    removed = list(dict.fromkeys(removed))
+
+    changed = stats["new"] or stats["updated"] or removed or pages.keys() != old_pages.keys()
+    if changed:
+        _retire_chunks(general_index_name, removed, version)
+        helpbook_manifest.commit(general_index_name, src_name, pages, version)
+        if removed:
+            # Nothing queries them any more
+            get_vectorstore(general_index_name).delete(ids=removed)
+    if on_progress:
+        on_progress(total_pages, total_pages, processed)
+
+    out = _result(processed, cache, stats, (time.perf_counter() - t_start) * 1000)
+    out.update(
+        pages_unchanged=pages_unchanged,
+        removed=len(removed),
+        version=helpbook_manifest.current_version(general_index_name),
+    )
+    trace_export.export_ingest("helpbook", general_index_name, 1, out)
+    return out
+
+# ingest patient files
+def ingest_patient_files(
+    files,
+    patient_index_name: str,
+    session_id: str,
+    summary_general_index: Optional[str] = None,
+    batch_size: int = INGEST_BATCH_SIZE,
+) -> Dict[str, float]:
+    """
+    Load one or more patient files and embed into the PATIENT index with session metadata.
+    Files are parsed in parallel (process pool) while earlier ones are already being
+    split, embedded and upserted.
+    If summary_general_index is given, the report summary starts generating in the
+    background as soon as the upload is embedded (see rag_tools.start_summary_job).
+    Returns chunk count, embed cache hits/misses, per-stage timings and throughput (see _result).
+    """
+    t_start = time.perf_counter()
+    stats = _new_stats()
+    touch_session(patient_index_name, session_id)
+    # Writes go to the vector partition for this session only
+    namespace = session_namespace(session_id)
+    # What the partition held before: the summary job waits for this run's new vectors on top
+    stored_before = session_vector_count(patient_index_name, session_id) if summary_general_index else 0
+    doc_versions: List[str] = []
+    processed = 0
+
+    def _pages() -> Iterator[Document]:
+        for src, docs, parse_ms in _iter_parsed(files):
+            stats["parse_ms"] += parse_ms
+            stats["pages"] += len(docs)
+
+            # Version of this document = hash of its name + extracted text
+            h = hashlib.sha256(src.encode("utf-8"))
+            for d in docs:
+                h.update(d.page_content.encode("utf-8"))
+            doc_versions.append(h.hexdigest())
+
+            # Structured lab values for instant Interpret_Lab lookups
+            labs.index_documents(session_id, docs)
+
+            # Tag page docs with session info (chunks inherit it when split)
+            for d in docs:
+                d.metadata = d.metadata or {}
+                d.metadata["session_id"] = session_id
+                d.metadata["kind"] = "patient"
+                d.metadata.setdefault("source", src)
+                yield d
+
+    def _on_batch(chunks: List[Document], pages_done: int):
+        nonlocal processed
+        processed += len(chunks)
+
+    with track_cache() as cache:
+        _pipelined_upsert(patient_index_name, namespace, _chunk_batches(_pages(), batch_size, stats),
+                          _on_batch, stats)
+
+    out = _result(processed, cache, stats, (time.perf_counter() - t_start) * 1000)
+    trace_export.export_ingest("patient", patient_index_name, len(doc_versions), out)
+    if not processed:
+        return out
+
+    # New documents for this session: its cached answers are no longer valid
+    answer_cache.note_session_documents(session_id, doc_versions)
+    if summary_general_index:
+        start_summary_job(summary_general_index, patient_index_name, session_id,
+                          min_vectors=stored_before + stats["new"])
+    return out
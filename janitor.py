@@ -0,0 +1,78 @@
+# ===========================================
+# file: janitor.py
+# Background garbage collection of idle patient sessions
+# ===========================================
+import os
+import time
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from vectorstore import delete_patient_session_vectors
+
+SESSION_TTL_S = float(os.getenv("SESSION_TTL_S", "7200"))        # idle time before a session is purged
+JANITOR_INTERVAL_S = float(os.getenv("JANITOR_INTERVAL_S", "300"))
+
+# (patient_index_name, session_id) -> last activity (monotonic seconds)
+_last_seen: Dict[Tuple[str, str], float] = {}
+_lock = threading.Lock()
+_expiry_hooks: List[Callable[[str], None]] = []
+_thread: Optional[threading.Thread] = None
+_log = logging.getLogger(__name__)
+
+
+def touch_session(patient_index_name: str, session_id: str):
+    """Mark a session as active (called on ingest and on every question)."""
+    with _lock:
+        _last_seen[(patient_index_name, session_id)] = time.monotonic()
+
+
+def forget_session(patient_index_name: str, session_id: str):
+    with _lock:
+        _last_seen.pop((patient_index_name, session_id), None)
+
+
+def on_session_expired(fn: Callable[[str], None]):
+    """Register extra per-session cleanup (e.g. chat memory) run when a session is collected."""
+    _expiry_hooks.append(fn)
+
+
+def collect_idle_sessions(ttl_s: float = SESSION_TTL_S) -> List[str]:
+    """Purge vectors (and registered per-session state) of sessions idle longer than ttl_s."""
+    now = time.monotonic()
+    with _lock:
+        idle = [key for key, seen in _last_seen.items() if now - seen > ttl_s]
+        for key in idle:
+            _last_seen.pop(key, None)
+
+    purged = []
+    for index_name, session_id in idle:
+        try:
+            delete_patient_session_vectors(index_name, session_id)
+            for hook in _expiry_hooks:
+                hook(session_id)
+            purged.append(session_id)
+        except Exception:
+            # Put it back so the next sweep retries
+            touch_session(index_name, session_id)
+            _log.exception("Failed to purge idle session %s", session_id)
+    return purged
+
+
+def _loop(interval_s: float, ttl_s: float):
+    while True:
+        time.sleep(interval_s)
+        collect_idle_sessions(ttl_s)
+
+
+def start_janitor(interval_s: float = JANITOR_INTERVAL_S, ttl_s: float = SESSION_TTL_S) -> threading.Thread:
+    """
+    Start the sweeper thread once per process (idempotent).
+    Note: only sessions seen by this process are tracked.
+    """
+    global _thread
+    with _lock:
+        if _thread is None or not _thread.is_alive():
+            _thread = threading.Thread(target=_loop, args=(interval_s, ttl_s), name="session-janitor", daemon=True)
+            _thread.start()
+    return _thread
@@ -0,0 +1,134 @@
+# ===========================================
+# file: labs.py
+# Structured lab-value extraction + per-session lookup table
+# ===========================================
+import re
+import threading
+from typing import Dict, List, Optional
+
+from langchain_core.documents import Document
+
+# "Haemoglobin (Hb)   11.1  L  g/dL   12.0 - 15.0"
+# "Platelet count: 250 x10^9/L (150-400)"
+_LAB_LINE = re.compile(
+    r"^\s*(?P<name>[A-Za-z][A-Za-z0-9 ()/,.'+\-]{1,60}?)\s*[:\-]?\s+"
+    r"(?P<value>[<>]?\d+(?:\.\d+)?)\s*"
+    r"(?:(?P<flag1>H|L|HIGH|LOW|High|Low)\b\s*)?"
+    r"(?P<unit>(?:[a-zA-Z%µμ/]|x10)[A-Za-z0-9%µμ/^.*]*)?\s*"
+    r"(?:(?P<flag2>H|L|HIGH|LOW|High|Low)\b\s*)?"
+    r"(?:[\[(]?\s*(?:ref(?:erence)?(?:\s*range)?\s*:?\s*)?"
+    r"(?P<low>\d+(?:\.\d+)?)\s*(?:-|–|to)\s*(?P<high>\d+(?:\.\d+)?)\s*[\])]?)?\s*$",
+    re.IGNORECASE,
+)
+
+# Common abbreviations/synonyms -> canonical key (keys are already normalised: "haem"->"hem", "leuc"->"leuk")
+_ALIASES = {
+    "hb": "hemoglobin", "hgb": "hemoglobin",
+    "wbc": "white blood cell count", "wbc count": "white blood cell count",
+    "total leukocyte count": "white blood cell count", "tlc": "white blood cell count",
+    "rbc": "red blood cell count", "rbc count": "red blood cell count",
+    "plt": "platelet count", "platelets": "platelet count",
+    "hct": "hematocrit", "pcv": "hematocrit",
+    "fbs": "fasting blood sugar", "fasting glucose": "fasting blood sugar", "glucose fasting": "fasting blood sugar",
+    "hba1c": "glycated hemoglobin", "tsh": "thyroid stimulating hormone",
+    "ldl": "ldl cholesterol", "hdl": "hdl cholesterol",
+}
+
+_lock = threading.Lock()
+# session_id -> canonical test key -> records
+_tables: Dict[str, Dict[str, List[dict]]] = {}
+
+
+def normalize_test_name(name: str) -> str:
+    key = re.sub(r"[^a-z0-9 ]+", " ", (name or "").lower())
+    key = " ".join(key.split())
+    key = key.replace("haem", "hem").replace("leuc", "leuk")
+    return _ALIASES.get(key, key)
+
+
+def _keys(name: str) -> List[str]:
+    """Index a test under its full name and any parenthesised abbreviation."""
+    keys = {normalize_test_name(name)}
+    m = re.match(r"^(.*?)\((.*?)\)\s*$", name)
+    if m:
+        keys.add(normalize_test_name(m.group(1)))
+        keys.add(normalize_test_name(m.group(2)))
+    return [k for k in keys if k]
+
+
+def _flag(value: str, low: Optional[str], high: Optional[str], given: Optional[str]) -> str:
+    if given:
+        return "high" if given.lower().startswith("h") else "low"
+    if low is None or high is None:
+        return ""
+    try:
+        v = float(value.lstrip("<>"))
+    except ValueError:
+        return ""
+    if v < float(low):
+        return "low"
+    if v > float(high):
+        return "high"
+    return "normal"
+
+
+def parse_lab_lines(text: str, page=None, source: str = "") -> List[dict]:
+    """Extract (test, value, unit, ref_range, flag, page, source) records from report text."""
+    records = []
+    for line in (text or "").splitlines():
+        m = _LAB_LINE.match(line)
+        if not m or len(m.group("name").strip()) < 2:
+            continue
+        low, high = m.group("low"), m.group("high")
+        records.append({
+            "test": m.group("name").strip(" :-"),
+            "value": m.group("value"),
+            "unit": m.group("unit") or "",
+            "ref_range": f"{low}-{high}" if low and high else "",
+            "flag": _flag(m.group("value"), low, high, m.group("flag1") or m.group("flag2")),
+            "page": page,
+            "source": source,
+        })
+    return records
+
+
+def index_documents(session_id: str, docs: List[Document]) -> int:
+    """Parse page documents and add their lab records to the session's table."""
+    added = 0
+    with _lock:
+        table = _tables.setdefault(session_id, {})
+        for d in docs:
+            meta = d.metadata or {}
+            for rec in parse_lab_lines(d.page_content, meta.get("page"), meta.get("source", "")):
+                for key in _keys(rec["test"]):
+                    rows = table.setdefault(key, [])
+                    if rec not in rows:  # re-uploading the same report adds nothing
+                        rows.append(rec)
+                added += 1
+    return added
+
+
+def lookup(session_id: str, test_name: str) -> List[dict]:
+    with _lock:
+        return list((_tables.get(session_id) or {}).get(normalize_test_name(test_name), []))
+
+
+def format_records(records: List[dict]) -> str:
+    """Compact [patient] context lines for the LLM prompt."""
+    out = []
+    for r in records:
+        line = f"[patient] {r['test']}: {r['value']} {r['unit']}".rstrip()
+        if r["ref_range"]:
+            line += f" (reference {r['ref_range']} {r['unit']})".replace("  ", " ")
+        if r["flag"]:
+            line += f" - {r['flag']}"
+        where = ", ".join(str(x) for x in (r["source"], f"page {r['page']}" if r["page"] is not None else "") if x)
+        if where:
+            line += f" [{where}]"
+        out.append(line)
+    return "\n".join(out)
+
+
+def forget_session(session_id: str):
+    with _lock:
+        _tables.pop(session_id, None)
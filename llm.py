@@ -1,19 +1,138 @@
 # ===========================================
 # file: llm.py
-# Gemini 1.5 Flash via LangChain
+# Gemini 1.5 Flash via LangChain (pooled clients + offline stub)
 # ===========================================
 import os
+import json
+import time
+import threading
+from typing import Any, Iterator, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
 from langchain_google_genai import ChatGoogleGenerativeAI
 from dotenv import load_dotenv
 
+from resources import get_resource
+from tracing import open_span, span
+
 load_dotenv()
 
-# Define llm using gemini
-def get_llm():
-    # Requires GOOGLE_API_KEY env var
-    return ChatGoogleGenerativeAI(
-        model="gemini-1.5-flash",
-        temperature=0.2,
-        max_output_tokens=1024,
-        convert_system_message_to_human= True 
+LLM_MODEL = os.getenv("LLM_MODEL", "gemini-1.5-flash")
+# "gemini" (default) or "stub" (deterministic offline model for load tests)
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini").lower()
+# Max LLM calls in flight per process, across all sessions
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_STUB_LATENCY_MS = float(os.getenv("LLM_STUB_LATENCY_MS", "0"))
+
+_llm_slots = threading.BoundedSemaphore(LLM_MAX_CONCURRENCY)
+
+
+class BoundedChatModel(BaseChatModel):
+    """Wraps a shared chat model; every call holds one of LLM_MAX_CONCURRENCY slots."""
+
+    inner: BaseChatModel
+
+    @property
+    def _llm_type(self) -> str:
+        return f"bounded-{self.inner._llm_type}"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager=None, **kwargs: Any) -> ChatResult:
+        with span("llm.generate", kind="llm", model=self.inner._llm_type) as sp:
+            t0 = time.perf_counter()
+            with _llm_slots:
+                sp.set(queue_ms=round((time.perf_counter() - t0) * 1000, 1))
+                return self.inner._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        # Generator: the span is attached but never made current (see tracing.open_span)
+        sp = open_span("llm.stream", kind="llm", model=self.inner._llm_type)
+        t0 = time.perf_counter()
+        status = "ok"
+        try:
+            with _llm_slots:
+                sp.set(queue_ms=round((time.perf_counter() - t0) * 1000, 1))
+                yield from self.inner._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+        except BaseException as e:
+            status = f"error: {e}"
+            raise
+        finally:
+            sp.finish(status)
+
+
+# ----------------------------
+# Offline stub
+# ----------------------------
+def _stub_reply(messages: List[BaseMessage]) -> str:
+    """
+    Deterministic replies shaped like what each caller expects:
+      - agent planning turn  -> call RAG_QA with the user's input
+      - agent after a tool   -> Final Answer echoing the tool output
+      - evaluator judges     -> a "Y" verdict
+      - RAG answer prompt    -> short cited answer
+    """
+    last = str(messages[-1].content) if messages else ""
+    every = "\n".join(str(m.content) for m in messages)
+
+    if "TOOL RESPONSE" in last:
+        tool_out = last.split("---------------------", 1)[-1].split("USER'S INPUT", 1)[0].strip()
+        return "```json\n" + json.dumps({"action": "Final Answer", "action_input": tool_out}) + "\n```"
+    if "RESPONSE FORMAT INSTRUCTIONS" in every:
+        user_input = last.split("NOTHING else):", 1)[-1].strip()
+        return "```json\n" + json.dumps({"action": "RAG_QA", "action_input": user_input}) + "\n```"
+    if "[BEGIN DATA]" in last:
+        return "The submission meets the criterion.\nY"
+
+    question = last.split("Question:", 1)[-1].split("\n", 1)[0].strip()[:120]
+    return (
+        f"In brief: stub answer for \"{question}\" [patient]. "
+        f"Reference values are summarised from the helpbook [helpbook]. "
+        f"Please discuss these results with a clinician."
     )
+
+
+class StubChatModel(BaseChatModel):
+    """Offline chat model with configurable latency (no network)."""
+
+    latency_ms: float = LLM_STUB_LATENCY_MS
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager=None, **kwargs: Any) -> ChatResult:
+        time.sleep(self.latency_ms / 1000.0)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=_stub_reply(messages)))])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        text = _stub_reply(messages)
+        words = text.split(" ")
+        per_token = self.latency_ms / 1000.0 / max(1, len(words))
+        for i, w in enumerate(words):
+            time.sleep(per_token)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=w if i == 0 else " " + w))
+
+
+def _build(model: str, temperature: float, max_output_tokens: int) -> BaseChatModel:
+    if LLM_BACKEND == "stub":
+        inner: BaseChatModel = StubChatModel()
+    else:
+        # Requires GOOGLE_API_KEY env var
+        inner = ChatGoogleGenerativeAI(
+            model=model,
+            temperature=temperature,
+            max_output_tokens=max_output_tokens,
+            convert_system_message_to_human= True
+        )
+    return BoundedChatModel(inner=inner)
+
+
+# Define llm using gemini (one shared client per settings combination)
+def get_llm(model: str = LLM_MODEL, temperature: float = 0.2, max_output_tokens: int = 1024) -> BaseChatModel:
+    key = f"llm:{LLM_BACKEND}:{model}:{temperature}:{max_output_tokens}"
+    return get_resource(key, lambda: _build(model, temperature, max_output_tokens))
@@ -0,0 +1,467 @@
+# ===========================================
+# file: local_index.py
+# In-process NumPy vector index (offline stand-in for Pinecone)
+# ===========================================
+import os
+import json
+import uuid
+import shutil
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+
+# ----------------------------
+# Metadata filters (Pinecone syntax subset)
+# ----------------------------
+def _match_op(value: Any, op: str, arg: Any) -> bool:
+    if op == "$eq":
+        return value == arg
+    if op == "$ne":
+        return value != arg
+    if op == "$in":
+        return value in arg
+    if op == "$nin":
+        return value not in arg
+    if value is None:
+        return False
+    if op == "$gt":
+        return value > arg
+    if op == "$gte":
+        return value >= arg
+    if op == "$lt":
+        return value < arg
+    if op == "$lte":
+        return value <= arg
+    raise ValueError(f"Unsupported filter operator: {op}")
+
+
+def matches_filter(metadata: Dict[str, Any], flt: Optional[Dict[str, Any]]) -> bool:
+    """
+    Supports {"field": value}, {"field": {"$eq"|"$ne"|"$in"|"$nin"|"$gt"|"$gte"|"$lt"|"$lte": ...}},
+    and {"$and": [...]} / {"$or": [...]}.
+    """
+    if not flt:
+        return True
+    for key, cond in flt.items():
+        if key == "$and":
+            if not all(matches_filter(metadata, c) for c in cond):
+                return False
+        elif key == "$or":
+            if not any(matches_filter(metadata, c) for c in cond):
+                return False
+        elif isinstance(cond, dict):
+            value = metadata.get(key)
+            if not all(_match_op(value, op, arg) for op, arg in cond.items()):
+                return False
+        elif metadata.get(key) != cond:
+            return False
+    return True
+
+
+def _normalize(x: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return x / norms
+
+
+def _is_number(x: Any) -> bool:
+    return isinstance(x, (int, float))
+
+
+_ORDER_OPS = {"$gt": np.greater, "$gte": np.greater_equal, "$lt": np.less, "$lte": np.less_equal}
+
+# The log is folded into a fresh snapshot once it is bigger than the snapshot (and this)
+LOG_COMPACT_MIN_BYTES = 1 << 20
+
+
+# ----------------------------
+# Storage
+# ----------------------------
+class LocalIndex:
+    """
+    One index = one directory:
+      vectors.f32  memory-mapped float32 array (capacity x dim), rows are L2-normalised
+      meta.json    snapshot of ids / texts / metadata for rows [0, count)
+      meta.log     writes since the snapshot, one JSON line each (replayed on load)
+    Rows stay contiguous: deleting a row moves the last row into the hole.
+    A write only appends its own rows to the log; the snapshot is rewritten when
+    the log outgrows it, so persisting stays linear in the rows written.
+    Filters are evaluated over per-field column arrays (rebuilt lazily after writes).
+    """
+
+    def __init__(self, path: str, dim: int):
+        self.path = path
+        self.dim = dim
+        self._lock = threading.RLock()
+        self._vec_path = os.path.join(path, "vectors.f32")
+        self._meta_path = os.path.join(path, "meta.json")
+        self._log_path = os.path.join(path, "meta.log")
+        self.ids: List[str] = []
+        self.texts: List[str] = []
+        self.metadatas: List[Dict[str, Any]] = []
+        self._row: Dict[str, int] = {}
+        self._arr: Optional[np.memmap] = None
+        # field -> (values as objects, values as float64 with NaN for non-numbers)
+        self._cols: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self._gen = 0
+        self._snapshot_bytes = 0
+        self._log_bytes = 0
+        self._load()
+
+    # --- persistence ---
+    def _load(self):
+        os.makedirs(self.path, exist_ok=True)
+        if os.path.exists(self._meta_path) and os.path.exists(self._vec_path):
+            with open(self._meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            self.dim = int(meta["dim"])
+            self._gen = int(meta.get("gen", 0))
+            self.ids, self.texts, self.metadatas = meta["ids"], meta["texts"], meta["metadatas"]
+            self._row = {i: r for r, i in enumerate(self.ids)}
+            self._snapshot_bytes = os.path.getsize(self._meta_path)
+            self._replay_log()
+            capacity = max(16, os.path.getsize(self._vec_path) // (4 * self.dim))
+            self._arr = np.memmap(self._vec_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+        else:
+            self._arr = np.memmap(self._vec_path, dtype=np.float32, mode="w+", shape=(16, self.dim))
+            self._write_snapshot()
+
+    def _replay_log(self):
+        """Apply the log written on top of this snapshot; a torn last line is cut off."""
+        good = 0
+        try:
+            with open(self._log_path, "rb") as f:
+                lines = f.read().splitlines(keepends=True)
+        except FileNotFoundError:
+            lines = []
+        for n, line in enumerate(lines):
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                break
+            if n == 0:
+                if rec.get("gen") != self._gen:
+                    break  # log of an older snapshot (crash while compacting)
+            elif rec["op"] == "upsert":
+                self._put_rows(rec["rows"])
+            elif rec["op"] == "delete":
+                self._drop_rows(rec["ids"])
+            elif rec["op"] == "metadata":
+                self._set_metadata(rec["updates"])
+            good += len(line)
+        if good == 0:
+            self._new_log()
+        elif good < sum(len(line) for line in lines):
+            with open(self._log_path, "r+b") as f:
+                f.truncate(good)
+        self._log_bytes = good
+
+    def _new_log(self):
+        tmp = self._log_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"gen": self._gen}) + "\n")
+        os.replace(tmp, self._log_path)
+        self._log_bytes = 0
+
+    def _write_snapshot(self):
+        self._arr.flush()
+        self._gen += 1
+        tmp = self._meta_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"dim": self.dim, "gen": self._gen,
+                       "ids": self.ids, "texts": self.texts, "metadatas": self.metadatas}, f)
+        os.replace(tmp, self._meta_path)
+        self._snapshot_bytes = os.path.getsize(self._meta_path)
+        # A crash before this leaves a log for the previous gen, which _replay_log skips
+        self._new_log()
+
+    def _append_log(self, record: Dict[str, Any]):
+        # Vectors first, so a logged row never points at an unwritten vector
+        self._arr.flush()
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        with open(self._log_path, "ab") as f:
+            f.write(line)
+        self._log_bytes += len(line)
+        self._cols.clear()
+        if self._log_bytes > max(LOG_COMPACT_MIN_BYTES, self._snapshot_bytes):
+            self._write_snapshot()
+
+    def _grow(self, needed: int):
+        capacity = int(self._arr.shape[0])
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        tmp = self._vec_path + ".tmp"
+        bigger = np.memmap(tmp, dtype=np.float32, mode="w+", shape=(capacity, self.dim))
+        bigger[: len(self.ids)] = self._arr[: len(self.ids)]
+        bigger.flush()
+        del bigger
+        self._arr.flush()
+        self._arr = None
+        os.replace(tmp, self._vec_path)
+        self._arr = np.memmap(self._vec_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    # --- row bookkeeping (shared by live writes and log replay; vectors are not touched) ---
+    def _put_rows(self, rows: List[list]) -> List[int]:
+        """rows = [[id, text, metadata], ...] -> row number of each."""
+        out = []
+        for i, text, meta in rows:
+            row = self._row.get(i)
+            if row is None:
+                row = len(self.ids)
+                self._row[i] = row
+                self.ids.append(i)
+                self.texts.append(text)
+                self.metadatas.append(meta)
+            else:
+                self.texts[row] = text
+                self.metadatas[row] = meta
+            out.append(row)
+        return out
+
+    def _drop_rows(self, ids: Iterable[str]) -> List[Tuple[int, int]]:
+        """Remove rows; returns the (from, to) row moves the vectors have to follow."""
+        moves = []
+        # From the bottom up, moving the last row into each hole
+        for row in sorted({self._row[i] for i in ids if i in self._row}, reverse=True):
+            last = len(self.ids) - 1
+            del self._row[self.ids[row]]
+            if row != last:
+                moves.append((last, row))
+                self.ids[row] = self.ids[last]
+                self.texts[row] = self.texts[last]
+                self.metadatas[row] = self.metadatas[last]
+                self._row[self.ids[row]] = row
+            self.ids.pop()
+            self.texts.pop()
+            self.metadatas.pop()
+        return moves
+
+    def _set_metadata(self, updates: Dict[str, Dict[str, Any]]) -> int:
+        changed = 0
+        for i, meta in updates.items():
+            row = self._row.get(i)
+            if row is not None:
+                self.metadatas[row] = {**self.metadatas[row], **meta}
+                changed += 1
+        return changed
+
+    # --- writes ---
+    def upsert(self, ids: List[str], vectors: List[List[float]], texts: List[str],
+               metadatas: List[Dict[str, Any]]):
+        if not ids:
+            return
+        vecs = _normalize(np.asarray(vectors, dtype=np.float32).reshape(len(ids), self.dim))
+        rows = [[i, text, dict(meta or {})] for i, text, meta in zip(ids, texts, metadatas)]
+        with self._lock:
+            self._grow(len(self.ids) + len(ids))
+            for row, vec in zip(self._put_rows(rows), vecs):
+                self._arr[row] = vec
+            self._append_log({"op": "upsert", "rows": rows})
+
+    def delete(self, ids: Optional[Iterable[str]] = None, flt: Optional[Dict[str, Any]] = None) -> int:
+        # Like Pinecone: no ids and no filter is an error, never "delete everything" (see drop())
+        if ids is None and not flt:
+            raise ValueError("delete() needs ids or a filter")
+        with self._lock:
+            if ids is not None:
+                doomed = [i for i in dict.fromkeys(ids) if i in self._row]
+            else:
+                doomed = [self.ids[r] for r in self._candidates(flt)]
+            if not doomed:
+                return 0
+            for src, dst in self._drop_rows(doomed):
+                self._arr[dst] = self._arr[src]
+            self._append_log({"op": "delete", "ids": doomed})
+            return len(doomed)
+
+    def update_metadata(self, updates: Dict[str, Dict[str, Any]]) -> int:
+        """
+        Merge fields into the metadata of existing rows (vectors untouched), like
+        Pinecone's update(set_metadata=...). Unknown ids are ignored.
+        """
+        with self._lock:
+            known = {i: dict(meta or {}) for i, meta in updates.items() if i in self._row}
+            if known:
+                self._set_metadata(known)
+                self._append_log({"op": "metadata", "updates": known})
+            return len(known)
+
+    # --- reads ---
+    def get_metadata(self, ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {i: dict(self.metadatas[self._row[i]]) for i in ids if i in self._row}
+
+    def _column(self, key: str) -> Tuple[np.ndarray, np.ndarray]:
+        col = self._cols.get(key)
+        if col is None:
+            values = [m.get(key) for m in self.metadatas]
+            obj = np.empty(len(values), dtype=object)
+            for r, v in enumerate(values):
+                obj[r] = v
+            num = np.array([v if _is_number(v) else np.nan for v in values], dtype=np.float64)
+            col = self._cols[key] = (obj, num)
+        return col
+
+    def _op_mask(self, key: str, op: str, arg: Any) -> np.ndarray:
+        obj, num = self._column(key)
+        if op in ("$eq", "$ne", "$in", "$nin"):
+            mask = np.zeros(len(obj), dtype=bool)
+            for a in (arg if op in ("$in", "$nin") else [arg]):
+                if _is_number(a):
+                    mask |= num == a
+                elif isinstance(a, str) or a is None:
+                    mask |= (obj == a).astype(bool)
+                else:
+                    mask |= np.fromiter((v == a for v in obj), dtype=bool, count=len(obj))
+            return ~mask if op in ("$ne", "$nin") else mask
+        if op in _ORDER_OPS and _is_number(arg):
+            with np.errstate(invalid="ignore"):
+                return _ORDER_OPS[op](num, arg)  # NaN (missing / not a number) compares False
+        return np.fromiter((_match_op(v, op, arg) for v in obj), dtype=bool, count=len(obj))
+
+    def _mask(self, flt: Dict[str, Any]) -> np.ndarray:
+        """Same semantics as matches_filter, over whole columns at once."""
+        mask = np.ones(len(self.ids), dtype=bool)
+        for key, cond in flt.items():
+            if key == "$and":
+                for c in cond:
+                    mask &= self._mask(c)
+            elif key == "$or":
+                any_mask = np.zeros(len(self.ids), dtype=bool)
+                for c in cond:
+                    any_mask |= self._mask(c)
+                mask &= any_mask
+            elif isinstance(cond, dict):
+                for op, arg in cond.items():
+                    mask &= self._op_mask(key, op, arg)
+            else:
+                mask &= self._op_mask(key, "$eq", cond)
+        return mask
+
+    def _candidates(self, flt: Optional[Dict[str, Any]]) -> np.ndarray:
+        n = len(self.ids)
+        if not flt:
+            return np.arange(n)
+        return np.flatnonzero(self._mask(flt))
+
+    def search(self, vector: List[float], k: int, flt: Optional[Dict[str, Any]] = None,
+               with_vectors: bool = False):
+        """Cosine top-k. Returns [(row, score)] (and the candidate vectors if asked)."""
+        q = _normalize(np.asarray(vector, dtype=np.float32))
+        with self._lock:
+            n = len(self.ids)
+            rows = self._candidates(flt)
+            if rows.size == 0:
+                return ([], np.zeros((0, self.dim), dtype=np.float32)) if with_vectors else []
+            # Score every row in place (no gather copy of the matrix), then keep the candidates
+            scores = self._arr[:n] @ q
+            if flt:
+                scores = scores[rows]
+            k = min(k, rows.size)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            hits = [(int(rows[i]), float(scores[i])) for i in top]
+            if with_vectors:
+                return hits, np.asarray(self._arr[rows[top]])
+            return hits
+
+    def mmr(self, vector: List[float], k: int, fetch_k: int, lambda_mult: float,
+            flt: Optional[Dict[str, Any]] = None) -> List[Tuple[int, float]]:
+        hits, cand = self.search(vector, fetch_k, flt, with_vectors=True)
+        if not hits:
+            return []
+        rel = np.array([s for _, s in hits], dtype=np.float32)
+        selected: List[int] = [0]
+        while len(selected) < min(k, len(hits)):
+            redundancy = (cand @ cand[selected].T).max(axis=1)
+            score = lambda_mult * rel - (1 - lambda_mult) * redundancy
+            score[selected] = -np.inf
+            selected.append(int(np.argmax(score)))
+        return [hits[i] for i in selected]
+
+    def document(self, row: int) -> Document:
+        return Document(page_content=self.texts[row], metadata=dict(self.metadatas[row]))
+
+    def drop(self):
+        with self._lock:
+            self._arr = None
+            self.ids, self.texts, self.metadatas, self._row = [], [], [], {}
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+# ----------------------------
+# LangChain wrapper
+# ----------------------------
+class LocalVectorStore(VectorStore):
+    """LangChain VectorStore over a LocalIndex (same call surface rag/ingest use on Pinecone)."""
+
+    def __init__(self, index: LocalIndex, embedding: Embeddings):
+        self._index = index
+        self._embedding = embedding
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None,
+                  ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [uuid.uuid4().hex for _ in texts]
+        self._index.upsert(ids, self._embedding.embed_documents(texts), texts, metadatas)
+        return ids
+
+    def delete(self, ids: Optional[List[str]] = None, filter: Optional[dict] = None, **kwargs: Any):
+        self._index.delete(ids=ids, flt=filter)
+        return True
+
+    def similarity_search_by_vector_with_score(self, embedding: List[float], k: int = 4,
+                                               filter: Optional[dict] = None, **kwargs: Any):
+        return [(self._index.document(r), s) for r, s in self._index.search(embedding, k, filter)]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4,
+                                    filter: Optional[dict] = None, **kwargs: Any) -> List[Document]:
+        return [d for d, _ in self.similarity_search_by_vector_with_score(embedding, k, filter)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4,
+                                     filter: Optional[dict] = None, **kwargs: Any):
+        return self.similarity_search_by_vector_with_score(self._embedding.embed_query(query), k, filter)
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[dict] = None,
+                          **kwargs: Any) -> List[Document]:
+        return [d for d, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def max_marginal_relevance_search_by_vector(self, embedding: List[float], k: int = 4,
+                                                fetch_k: int = 20, lambda_mult: float = 0.5,
+                                                filter: Optional[dict] = None,
+                                                **kwargs: Any) -> List[Document]:
+        hits = self._index.mmr(embedding, k, fetch_k, lambda_mult, filter)
+        return [self._index.document(r) for r, _ in hits]
+
+    def max_marginal_relevance_search(self, query: str, k: int = 4, fetch_k: int = 20,
+                                      lambda_mult: float = 0.5, filter: Optional[dict] = None,
+                                      **kwargs: Any) -> List[Document]:
+        return self.max_marginal_relevance_search_by_vector(
+            self._embedding.embed_query(query), k, fetch_k, lambda_mult, filter
+        )
+
+    def _select_relevance_score_fn(self):
+        # Scores are already cosine similarities in [-1, 1]
+        return lambda score: (score + 1.0) / 2.0
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+                   path: str = ".vector_index/default", dim: int = 384, **kwargs: Any) -> "LocalVectorStore":
+        store = cls(LocalIndex(path, dim), embedding)
+        store.add_texts(texts, metadatas=metadatas, **kwargs)
+        return store
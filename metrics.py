@@ -1,11 +1,26 @@
 # metrics.py
 # Summarize one session (avg faith/help + avg latencies + useful rates) and append to CSV.
 
-import csv, time, pathlib, statistics
+import os, csv, time, hashlib, pathlib, statistics, threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import lru_cache
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 from langchain.evaluation import load_evaluator
 from llm import get_llm
+from metrics_store import get_metrics_store
+
+# Judge calls in flight at once (each also takes an llm.py concurrency slot)
+JUDGE_WORKERS = int(os.getenv("JUDGE_WORKERS", "4"))
+JUDGE_CACHE_MAX_ENTRIES = int(os.getenv("JUDGE_CACHE_MAX_ENTRIES", "5000"))
+
+_judge_pool = ThreadPoolExecutor(max_workers=JUDGE_WORKERS, thread_name_prefix="judge")
+# One background evaluation at a time, so CSV rows are appended in order
+_eval_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-eval")
+
+# (judge, question, answer, context) hash -> score
+_verdicts: "OrderedDict[str, float]" = OrderedDict()
+_verdicts_lock = threading.Lock()
 
 def _to_float(x, default=0.0):
     try: return float(x)
@@ -29,14 +44,51 @@ def _get_judges():
     # return helpfulness and faithfulness metrics
     return faith, helpf
 
+def _verdict_key(judge: str, q: str, a: str, c: str) -> str:
+    return hashlib.sha256("\x00".join((judge, q, a, c)).encode("utf-8")).hexdigest()
+
+def _judge(judge: str, evaluator, q: str, a: str, c: str) -> float:
+    """One judge verdict, served from the verdict cache when this exact turn was scored before."""
+    key = _verdict_key(judge, q, a, c)
+    with _verdicts_lock:
+        if key in _verdicts:
+            _verdicts.move_to_end(key)
+            return _verdicts[key]
+    if judge == "faithfulness":
+        score = _to_float(evaluator.evaluate_strings(prediction=a, input=q, reference=c).get("score"))
+    else:
+        score = _to_float(evaluator.evaluate_strings(prediction=a, input=q).get("score"))
+    with _verdicts_lock:
+        _verdicts[key] = score
+        while len(_verdicts) > JUDGE_CACHE_MAX_ENTRIES:
+            _verdicts.popitem(last=False)
+    return score
+
+def _score_turns(turns: List[Dict]) -> List[Tuple[float, float]]:
+    """Faithfulness + helpfulness for every scorable turn, all judge calls run concurrently."""
+    faith_eval, help_eval = _get_judges()
+    jobs = []
+    for t in turns:
+        q = (t.get("q") or "").strip()
+        a = (t.get("answer") or "").strip()
+        c = (t.get("context") or "").strip()
+        if q and a and c:
+            jobs.append((
+                _judge_pool.submit(_judge, "faithfulness", faith_eval, q, a, c),
+                _judge_pool.submit(_judge, "helpfulness", help_eval, q, a, c),
+            ))
+    return [(f.result(), h.result()) for f, h in jobs]
+
 def summarize_session(turns: List[Dict], faith_threshold: float = 0.5) -> Dict[str, float]:
     """
     Each turn: {"q":str, "answer":str, "context":str, "ts":..., "metrics":{...}}
-      where metrics (set in rag.py) may include:
-        latency_ms_total, latency_ms_retrieval, latency_ms_llm,
+      where metrics (rag.turn_metrics over the turn's trace) may include:
+        latency_ms_total, latency_ms_first_token, latency_ms_retrieval, latency_ms_llm,
+        latency_ms_retrieval_patient, latency_ms_retrieval_helpbook,
         retrieved_docs_patient, retrieved_docs_helpbook,
         used_patient_in_answer, used_helpbook_in_answer, fallback_used,
-        context_chars, answer_chars
+        context_chars, context_tokens, context_tokens_saved, answer_chars,
+        latency_ms_turn, rag_calls, llm_calls, tool_calls
     Returns a flat dict ready to write to CSV.
     """
     if not turns:
@@ -51,8 +103,10 @@ def summarize_session(turns: List[Dict], faith_threshold: float = 0.5) -> Dict[s
             "hallucination_rate_pct": 0.0,
         }
 
-    faith_eval, help_eval = _get_judges()
-    f_scores, h_scores = [], []
+    # Evaluate faithfulness and helpfulness (concurrent, cached per turn)
+    scores = _score_turns(turns)
+    f_scores = [f for f, _ in scores]
+    h_scores = [h for _, h in scores]
 
     lat_total=[]; lat_ret=[]; lat_llm=[]
     used_patient=[]; used_helpbook=[]; fallback=[]
@@ -60,14 +114,8 @@ def summarize_session(turns: List[Dict], faith_threshold: float = 0.5) -> Dict[s
     ret_succ=[]; rdp=[]; rdh=[]
 
     for t in turns:
-        q = (t.get("q") or "").strip()
         a = (t.get("answer") or "").strip()
         c = (t.get("context") or "").strip()
-        if q and a and c:
-            # Evaluate faithfulness and helpfulness
-            f = faith_eval.evaluate_strings(prediction=a, input=q, reference=c).get("score")
-            h = help_eval.evaluate_strings(prediction=a, input=q).get("score")
-            f_scores.append(_to_float(f)); h_scores.append(_to_float(h))
 
         m = t.get("metrics") or {}
         def num(k):
@@ -131,3 +179,14 @@ def append_session_summary(csv_path: str, session_id: str,
         w = csv.DictWriter(f, fieldnames=list(row.keys()))
         if write_header: w.writeheader()
         w.writerow(row)
+
+# Score + append a finished session off the UI thread (CSV + metrics store)
+def start_session_summary_job(turns: List[Dict], csv_path: str, session_id: str,
+                              extra: Optional[Dict[str, object]] = None) -> Future:
+    turns = list(turns)  # the caller resets its turn log right away
+    def run():
+        summary = summarize_session(turns)
+        append_session_summary(csv_path, session_id, summary, extra)
+        get_metrics_store().record_session(session_id, summary)
+        return summary
+    return _eval_pool.submit(run)
@@ -0,0 +1,196 @@
+# ===========================================
+# file: metrics_store.py
+# Append-only SQLite metrics store with percentile / histogram queries
+# ===========================================
+import os
+import csv
+import math
+import time
+import sqlite3
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Union
+
+from resources import get_resource
+
+METRICS_DB_PATH = os.getenv("METRICS_DB_PATH", "metrics.sqlite3")
+
+# Default histogram bucket edges for millisecond metrics
+LATENCY_BUCKETS_MS = (100, 250, 500, 1000, 2000, 5000, 10000, 20000)
+
+# One row per (turn, metric): every metric is its own "column" stored contiguously
+# in the (metric, value) index, so a percentile over one metric never reads the others.
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS turns (
+    turn_id    INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    ts         REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS turn_metrics (
+    session_id TEXT NOT NULL,
+    turn_id    INTEGER NOT NULL,
+    ts         REAL NOT NULL,
+    metric     TEXT NOT NULL,
+    value      REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS turn_metrics_metric_value ON turn_metrics (metric, value);
+CREATE INDEX IF NOT EXISTS turn_metrics_metric_ts ON turn_metrics (metric, ts);
+CREATE INDEX IF NOT EXISTS turn_metrics_session ON turn_metrics (session_id);
+CREATE TABLE IF NOT EXISTS session_metrics (
+    session_id TEXT NOT NULL,
+    ts         REAL NOT NULL,
+    metric     TEXT NOT NULL,
+    value      REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS session_metrics_metric_value ON session_metrics (metric, value);
+"""
+
+
+def _numeric(metrics: Dict[str, Any]) -> List[tuple]:
+    """Numbers and booleans only (bools as 0/1); text fields stay in the trace export."""
+    out = []
+    for k, v in metrics.items():
+        if isinstance(v, bool):
+            out.append((k, 1.0 if v else 0.0))
+        elif isinstance(v, (int, float)):
+            out.append((k, float(v)))
+    return out
+
+
+class MetricsStore:
+    def __init__(self, path: str = METRICS_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+            # Stores written before the turns table existed: register their turn ids
+            self._conn.execute(
+                "INSERT INTO turns (turn_id, session_id, ts) "
+                "SELECT turn_id, MIN(session_id), MIN(ts) FROM turn_metrics "
+                "WHERE turn_id NOT IN (SELECT turn_id FROM turns) GROUP BY turn_id"
+            )
+
+    # --- ingestion (append-only) ---
+    def record_turn(self, session_id: str, metrics: Dict[str, Any], ts: Optional[float] = None) -> int:
+        """Append one turn's metrics as soon as the turn ends. Returns the turn id."""
+        ts = ts if ts is not None else time.time()
+        rows = _numeric(metrics)
+        with self._lock, self._conn:
+            # AUTOINCREMENT hands out the id under SQLite's write lock: unique across processes
+            turn_id = self._conn.execute(
+                "INSERT INTO turns (session_id, ts) VALUES (?, ?)", (session_id, ts)
+            ).lastrowid
+            self._conn.executemany(
+                "INSERT INTO turn_metrics (session_id, turn_id, ts, metric, value) VALUES (?, ?, ?, ?, ?)",
+                [(session_id, turn_id, ts, k, v) for k, v in rows],
+            )
+        return turn_id
+
+    def record_session(self, session_id: str, summary: Dict[str, Any], ts: Optional[float] = None):
+        ts = ts if ts is not None else time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO session_metrics (session_id, ts, metric, value) VALUES (?, ?, ?, ?)",
+                [(session_id, ts, k, v) for k, v in _numeric(summary)],
+            )
+
+    def import_session_csv(self, csv_path: str) -> int:
+        """Load an existing session_metrics.csv (one-off migration). Returns rows imported."""
+        n = 0
+        with open(csv_path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                try:
+                    ts = time.mktime(time.strptime(row.get("ts", ""), "%Y-%m-%d %H:%M:%S"))
+                except ValueError:
+                    ts = 0.0
+                values = {}
+                for k, v in row.items():
+                    try:
+                        values[k] = float(v)
+                    except (TypeError, ValueError):
+                        continue
+                self.record_session(row.get("session_id") or "", values, ts=ts)
+                n += 1
+        return n
+
+    # --- queries ---
+    def query(self, sql: str, params: Sequence[Any] = ()) -> List[Dict[str, Any]]:
+        """Run any read-only SQL against the store; rows come back as dicts."""
+        with self._lock:
+            cur = self._conn.execute(sql, tuple(params))
+            cols = [c[0] for c in cur.description or ()]
+            return [dict(zip(cols, r)) for r in cur.fetchall()]
+
+    def _where(self, metric: str, since: Optional[float], session_id: Optional[str]):
+        sql, params = "metric = ?", [metric]
+        if since is not None:
+            sql += " AND ts >= ?"
+            params.append(since)
+        if session_id is not None:
+            sql += " AND session_id = ?"
+            params.append(session_id)
+        return sql, params
+
+    def metrics(self, table: str = "turn_metrics") -> List[str]:
+        if table not in ("turn_metrics", "session_metrics"):
+            raise ValueError(f"Unknown metrics table '{table}'")
+        return [r["metric"] for r in self.query(f"SELECT DISTINCT metric FROM {table} ORDER BY metric")]
+
+    def percentiles(self, metric: str, ps: Iterable[float] = (50, 95, 99), since: Optional[float] = None,
+                    session_id: Optional[str] = None) -> Dict[str, float]:
+        """
+        Nearest-rank percentiles of one turn metric, read off the (metric, value) index.
+        SQLite's OFFSET steps over the skipped entries, so each lookup walks the index
+        from whichever end is nearer: about min(k, n - k) rows (p99 of 100k turns ~ 1k rows).
+        With `since`/`session_id` the walk also passes rows those filters reject. The
+        n/mean/max pass before it reads every row of the metric once.
+        """
+        where, params = self._where(metric, since, session_id)
+        with self._lock:
+            n, mean, mx = self._conn.execute(
+                f"SELECT COUNT(*), AVG(value), MAX(value) FROM turn_metrics WHERE {where}", params
+            ).fetchone()
+            if not n:
+                return {"n": 0}
+            out = {"n": n, "mean": round(mean, 1), "max": round(mx, 1)}
+            for p in ps:
+                k = min(n, max(1, math.ceil(p * n / 100))) - 1
+                order, offset = ("ASC", k) if k < n - 1 - k else ("DESC", n - 1 - k)
+                (v,) = self._conn.execute(
+                    f"SELECT value FROM turn_metrics WHERE {where} ORDER BY value {order} LIMIT 1 OFFSET ?",
+                    params + [offset],
+                ).fetchone()
+                out[f"p{p:g}"] = round(v, 1)
+        return out
+
+    def histogram(self, metric: str, edges: Sequence[float] = LATENCY_BUCKETS_MS,
+                  since: Optional[float] = None, session_id: Optional[str] = None) -> Dict[str, int]:
+        """Counts per bucket: "<100", "100-250", ..., ">=20000" (one SQL pass)."""
+        edges = sorted(edges)
+        labels = [f"<{edges[0]:g}"] + [f"{a:g}-{b:g}" for a, b in zip(edges, edges[1:])] + [f">={edges[-1]:g}"]
+        cases = " ".join(f"WHEN value < {float(e)!r} THEN {i}" for i, e in enumerate(edges))
+        where, params = self._where(metric, since, session_id)
+        rows = self.query(
+            f"SELECT CASE {cases} ELSE {len(edges)} END AS bucket, COUNT(*) AS n "
+            f"FROM turn_metrics WHERE {where} GROUP BY bucket",
+            params,
+        )
+        counts = {label: 0 for label in labels}
+        for r in rows:
+            counts[labels[r["bucket"]]] = r["n"]
+        return counts
+
+    def stage_summary(self, prefix: Union[str, tuple] = ("latency_ms_", "stage_ms_"), since: Optional[float] = None,
+                      session_id: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+        """p50/p95/p99 + histogram for every turn metric whose name starts with `prefix`."""
+        out = {}
+        for m in self.metrics():
+            if m.startswith(prefix):
+                out[m] = dict(self.percentiles(m, since=since, session_id=session_id),
+                              histogram=self.histogram(m, since=since, session_id=session_id))
+        return out
+
+
+def get_metrics_store() -> MetricsStore:
+    return get_resource("metrics_store", MetricsStore)
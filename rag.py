@@ -1,19 +1,58 @@
 # ===========================================
 # Dual-retriever merge + prompt + LLM call + memory
 # ===========================================
-from typing import List, Dict, Optional,Union
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from typing import Any, Callable, Iterator, List, Dict, Optional, Tuple, Union
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.documents import Document
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.runnables import RunnablePassthrough
 from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_community.chat_message_histories import ChatMessageHistory
 
-from vectorstore import get_vectorstore
+from vectorstore import (
+    get_vectorstore,
+    mmr_search_by_vector,
+    similarity_search_by_vector,
+    session_namespace,
+)
+from embeddings import get_embeddings
+from helpbook_manifest import version_filter
+from history import estimate_tokens, get_history_store, history_window
 from llm import get_llm
+from janitor import touch_session, on_session_expired
+import tracing
+from tracing import annotate, span
 
 import time
-_last_context = ""; _last_metrics = {}
-def get_last_context(): return _last_context
-def get_last_metrics(): return _last_metrics
+
+# Max tokens of retrieved text (helpbook + patient) put into one prompt
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2000"))
+
+# Helpbook + patient retrieval run side by side; each branch has its own deadline
+HELPBOOK_RETRIEVAL_TIMEOUT_S = float(os.getenv("HELPBOOK_RETRIEVAL_TIMEOUT_S", "6"))
+PATIENT_RETRIEVAL_TIMEOUT_S = float(os.getenv("PATIENT_RETRIEVAL_TIMEOUT_S", "15"))
+_retrieval_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("RETRIEVAL_WORKERS", "8")), thread_name_prefix="retrieval"
+)
+
+# Where streamed answer tokens go for the current turn (e.g. the chat pane), if anywhere
+_token_sink: ContextVar[Optional[Callable[[str], None]]] = ContextVar("rag_token_sink", default=None)
+
+@contextmanager
+def stream_tokens_to(sink: Callable[[str], None]):
+    """
+    Forward every answer token produced inside the block to sink(token):
+        with stream_tokens_to(on_token):
+            agent.run(user_msg)   # RAG tools stream through to on_token
+    """
+    token = _token_sink.set(sink)
+    try:
+        yield
+    finally:
+        _token_sink.reset(token)
 
 SYSTEM_PROMPT = """You are a careful clinical reasoning assistant.
 You are a careful clinical reasoning assistant.
@@ -63,16 +102,11 @@ QUESTION_PROMPT = ChatPromptTemplate.from_messages(
     ]
 )
 
-# In-memory store
-_memory_store: dict[str, ChatMessageHistory] = {}
+# get chat history (bounded store; see history.py)
+def _get_history(session_id: str) -> BaseChatMessageHistory:
+    return get_history_store().get(session_id)
 
-# get chat history
-def _get_history(session_id: str) -> ChatMessageHistory:
-    if session_id not in _memory_store:
-        _memory_store[session_id] = ChatMessageHistory()
-    return _memory_store[session_id]
-
-def _history_resolver(cfg: Union[str, Dict]) -> ChatMessageHistory:
+def _history_resolver(cfg: Union[str, Dict]) -> BaseChatMessageHistory:
     """
     LangChain sometimes passes just the session_id (str),
     other times a dict like {'configurable': {'session_id': '...'}}.
@@ -94,103 +128,325 @@ def _format_docs(tag: str, docs: List[Document]) -> str:
         out.append(f"[{tag}] {chunk}")
     return "\n".join(out)
 
-# Answer qn using content retrival and RAG
-def answer_question(
+def _overlap(a: str, b: str, max_len: int = 400, min_len: int = 20) -> int:
+    """Length of the longest suffix of a that is also a prefix of b (the splitter overlap)."""
+    for k in range(min(len(a), len(b), max_len), min_len - 1, -1):
+        if a.endswith(b[:k]):
+            return k
+    return 0
+
+def _merge_chunks(docs: List[Document]) -> List[Tuple[int, str]]:
+    """
+    Collapse retrieved chunks into blocks of text:
+    - chunks from the same source/page that follow each other are stitched together,
+      dropping the overlapping text the splitter repeats at chunk boundaries
+    - chunks contained in another block are dropped
+    Returns [(rank, text)] where rank is the best retrieval position among the block's chunks.
+    """
+    blocks: List[List] = []  # [rank, source/page key, text]
+    for rank, d in enumerate(docs):
+        text = d.page_content.strip()
+        if not text:
+            continue
+        key = (d.metadata.get("source"), d.metadata.get("page"))
+        for b in blocks:
+            if b[1] != key:
+                continue
+            if text in b[2]:
+                break
+            if b[2] in text:
+                b[2] = text
+                break
+            k = _overlap(b[2], text)
+            if k:
+                b[2] = b[2] + text[k:]
+                break
+            k = _overlap(text, b[2])
+            if k:
+                b[2] = text + b[2][k:]
+                break
+        else:
+            blocks.append([rank, key, text])
+    return [(b[0], b[2]) for b in blocks]
+
+def _build_context(sections: List[Tuple[str, List[Document]]], budget: int = CONTEXT_TOKEN_BUDGET) -> Tuple[str, int]:
+    """
+    Token-budgeted replacement for joining _format_docs() output:
+    merge/dedupe chunks per section, take blocks best-ranked first (sections interleaved
+    by relative rank, ties go to the earlier section) until `budget` tokens are used,
+    then emit the kept blocks section by section.
+    Returns (context text, tokens saved versus the unbudgeted join).
+    """
+    raw_tokens = sum(estimate_tokens(_format_docs(tag, docs)) for tag, docs in sections if docs)
+    candidates = []
+    for order, (tag, docs) in enumerate(sections):
+        for rank, text in _merge_chunks(docs or []):
+            candidates.append((rank / max(1, len(docs)), order, rank, tag, text.replace("\n", " ")))
+    candidates.sort()
+
+    chosen = []
+    used = 0
+    for rel, order, rank, tag, text in candidates:
+        cost = estimate_tokens(text)
+        if used + cost > budget:
+            left = budget - used
+            if left >= 50:
+                # Cut the last block at a word boundary instead of dropping it
+                text = text[: left * 4].rsplit(" ", 1)[0] + " …"
+                chosen.append((order, rank, tag, text))
+                used += estimate_tokens(text)
+            break
+        chosen.append((order, rank, tag, text))
+        used += cost
+    chosen.sort()
+    context = "\n".join(f"[{tag}] {text}" for _, _, tag, text in chosen)
+    return context, max(0, raw_tokens - used)
+
+# Retrieval branches (run on the retrieval pool)
+def _retrieve_helpbook(general_index_name: str, question: str) -> Tuple[List[Document], bool]:
+    with span("retrieval.helpbook", kind="retrieval", index=general_index_name) as sp:
+        general_vs = get_vectorstore(general_index_name)
+        question_vec = get_embeddings().embed_query(question)  # served from the query LRU on repeats
+        # Only the live helpbook version (re-ingests switch over atomically)
+        docs = mmr_search_by_vector(
+            general_vs, question_vec, k=6, fetch_k=100, lambda_mult=0.2,
+            filter=version_filter(general_index_name),
+        )
+        sp.set(docs=len(docs))
+        return docs, False
+
+def _retrieve_patient(patient_index_name: str, patient_query: str, session_id: str) -> Tuple[List[Document], bool]:
+    with span("retrieval.patient", kind="retrieval", index=patient_index_name) as sp:
+        patient_docs, fallback_used = _search_patient(patient_index_name, patient_query, session_id)
+        sp.set(docs=len(patient_docs), fallback_used=fallback_used)
+        return patient_docs, fallback_used
+
+def _search_patient(patient_index_name: str, patient_query: str, session_id: str) -> Tuple[List[Document], bool]:
+    # Only this session's partition is searched, so no metadata filter is needed
+    patient_vs = get_vectorstore(patient_index_name, namespace=session_namespace(session_id))
+    patient_vec = get_embeddings().embed_query(patient_query)
+    patient_docs = mmr_search_by_vector(
+        patient_vs, patient_vec, k=10, fetch_k=50, lambda_mult=0.35,
+    )
+
+    # --- Fallback if the session partition is empty (e.g. docs ingested before partitioning) ---
+    # Still this session's chunks only: never another patient's
+    fallback_used=False
+    if not patient_docs:
+        shared_vs = get_vectorstore(patient_index_name)  # shared/default partition
+        patient_docs = similarity_search_by_vector(
+            shared_vs, patient_vec, k=8, filter={"session_id": {"$eq": session_id}},
+        )
+        fallback_used = bool(patient_docs)
+    return patient_docs, fallback_used
+
+def _timed(fn, *args) -> Tuple[Any, float]:
+    t = time.perf_counter()
+    out = fn(*args)
+    return out, round((time.perf_counter() - t) * 1000, 1)
+
+def _await_branch(fut, started: float, timeout_s: float):
+    """
+    Wait for one retrieval branch until its own deadline.
+    Returns (docs, fallback_used, latency_ms, status) with status "ok" | "timeout" | "error".
+    A slow or failing branch degrades to no docs instead of failing the whole answer.
+    """
+    remaining = max(0.0, started + timeout_s - time.perf_counter())
+    try:
+        (docs, fallback_used), ms = fut.result(timeout=remaining)
+        return docs, fallback_used, ms, "ok"
+    except FuturesTimeout:
+        return [], False, round(timeout_s * 1000, 1), "timeout"
+    except Exception as e:
+        return [], False, round((time.perf_counter() - started) * 1000, 1), f"error: {e}"
+
+# Stream the answer to a qn using content retrival and RAG
+def stream_answer(
     question: str,
     general_index_name: str,
     patient_index_name: str,
     session_id: str,
     chat_history: Optional[List[Dict[str, str]]] = None,
-) -> str:
+    patient_context: Optional[str] = None,
+    use_history: bool = True,
+) -> Iterator[str]:
+    """
+    Yields answer tokens as the LLM produces them; metrics are saved once the stream ends.
+    patient_context: pre-extracted [patient] facts (e.g. from labs.py); when given, the
+    patient index is not searched and only the helpbook is retrieved.
+    use_history=False: answer without reading or writing the session's chat history
+    (background jobs the user did not ask for).
+    """
     t0 = time.perf_counter()
-    # Build retrievers
-    general_vs = get_vectorstore(general_index_name)
-    patient_vs = get_vectorstore(patient_index_name)
-
-    # Retrieve
-    general_ret = general_vs.as_retriever(
-        search_type="mmr",
-        search_kwargs={"k": 6, "fetch_k": 100, "lambda_mult": 0.2},
-    )
-    patient_ret = patient_vs.as_retriever(
-        search_type="mmr",
-        search_kwargs={
-            "k": 10,
-            "fetch_k": 50,
-            "lambda_mult": 0.35,
-            "filter": {"session_id": {"$eq": session_id}},
-        },
-    )
+    touch_session(patient_index_name, session_id)
 
     patient_query = (
         question
         + " include exact units, reference ranges, and any symptoms/advisory sections"
     )
 
-    # Fetch relevant documents based on the query
-    general_docs = general_ret.get_relevant_documents(question)
-    patient_docs = patient_ret.get_relevant_documents(patient_query)
+    # Fetch relevant documents for both indexes concurrently
+    general_fut = tracing.submit(_retrieval_pool, _timed, _retrieve_helpbook, general_index_name, question)
+    if patient_context is None:
+        patient_fut = tracing.submit(
+            _retrieval_pool, _timed, _retrieve_patient, patient_index_name, patient_query, session_id
+        )
+        patient_docs, fallback_used, ms_patient, patient_status = _await_branch(
+            patient_fut, t0, PATIENT_RETRIEVAL_TIMEOUT_S
+        )
+    else:
+        patient_docs, fallback_used, ms_patient, patient_status = [], False, 0.0, "structured"
+    general_docs, _, ms_helpbook, helpbook_status = _await_branch(
+        general_fut, t0, HELPBOOK_RETRIEVAL_TIMEOUT_S
+    )
+    if patient_status.startswith("error") and helpbook_status.startswith("error"):
+        # Nothing to ground on at all: surface the failure rather than answer blind
+        raise RuntimeError(f"Retrieval failed ({patient_status}; {helpbook_status})")
 
-    # --- Fallback if filter produced 0 docs (likely session_id mismatch) ---
-    fallback_used=False
-    if not patient_docs:
-        broad_hits = patient_vs.similarity_search(patient_query, k=8)  # no filter
-        if broad_hits:
-            fallback_used=True
-            # Use the session_id we actually find in the index (helps if your UI rotated IDs)
-            fallback_sid = broad_hits[0].metadata.get("session_id")
-            patient_docs = [d for d in broad_hits if d.metadata.get("session_id") == fallback_sid][:10]
-
-    # Merge contexts
+    # Merge contexts (deduped and cut to CONTEXT_TOKEN_BUDGET)
     ctx = []
-    if general_docs:
-        ctx.append(_format_docs("helpbook", general_docs))
-    if patient_docs:
-        ctx.append(_format_docs("patient", patient_docs))
+    retrieved, tokens_saved = _build_context(
+        [("patient", patient_docs or []), ("helpbook", general_docs or [])],  # patient wins ties
+        budget=max(0, CONTEXT_TOKEN_BUDGET - (estimate_tokens(patient_context) if patient_context else 0)),
+    )
+    if retrieved:
+        ctx.append(retrieved)
+    if patient_context:
+        ctx.append(patient_context)
     context = "\n".join(ctx) if ctx else "No retrieved context."
     #print("Patient context: ", patient_docs)
     #print("Context: ",context)
 
-    global _last_context
-    _last_context = context
+    annotate(context=context)
 
     t_ret = time.perf_counter()
 
     # LLM + memory
     llm = get_llm()
-    core_chain = QUESTION_PROMPT | llm
-
-    chain_with_memory = RunnableWithMessageHistory(
-        core_chain,
-        _history_resolver,                 # <-- robust resolver
-        input_messages_key="question",
-        history_messages_key="history",
+    # Only the most recent turns that fit HISTORY_TOKEN_BUDGET reach the prompt
+    core_chain = (
+        RunnablePassthrough.assign(history=lambda x: history_window(x.get("history") or []))
+        | QUESTION_PROMPT
+        | llm
     )
 
-    # get response based on the context retrieved
-    resp = chain_with_memory.invoke(
-        {"question": question, "context": context},
+    if use_history:
+        chain = RunnableWithMessageHistory(
+            core_chain,
+            _history_resolver,                 # <-- robust resolver
+            input_messages_key="question",
+            history_messages_key="history",
+        )
+        inputs = {"question": question, "context": context}
+    else:
+        chain = core_chain
+        inputs = {"question": question, "context": context, "history": []}
+
+    # stream the response based on the context retrieved
+    parts: List[str] = []
+    t_first = None
+    for chunk in chain.stream(
+        inputs,
         config={"configurable": {"session_id": session_id}},
-    )
+    ):
+        piece = getattr(chunk, "content", str(chunk))
+        if not piece:
+            continue
+        if t_first is None:
+            t_first = time.perf_counter()
+        parts.append(piece)
+        yield piece
 
     t_end = time.perf_counter()
-    answer_text = getattr(resp, "content", str(resp))
+    answer_text = "".join(parts)
 
-    # Save performance metrics
-    global _last_metrics
-    _last_metrics = {
+    # Save performance metrics on the current span (see tracing.py / turn_metrics)
+    annotate(**{
         "latency_ms_total": round((t_end - t0) * 1000, 1),
         "latency_ms_retrieval": round((t_ret - t0) * 1000, 1),
         "latency_ms_llm": round((t_end - t_ret) * 1000, 1),
-        "retrieved_docs_patient": len(patient_docs or []),
+        "latency_ms_first_token": round(((t_first or t_end) - t0) * 1000, 1),
+        "latency_ms_retrieval_patient": ms_patient,
+        "latency_ms_retrieval_helpbook": ms_helpbook,
+        "retrieval_status_patient": patient_status,
+        "retrieval_status_helpbook": helpbook_status,
+        "retrieved_docs_patient": len(patient_docs or []) or len((patient_context or "").splitlines()),
         "retrieved_docs_helpbook": len(general_docs or []),
         "used_patient_in_answer": "[patient]" in answer_text,
         "used_helpbook_in_answer": "[helpbook]" in answer_text,
         "fallback_used": fallback_used,
         "context_chars": len(context),
+        "context_tokens": estimate_tokens(context),
+        "context_tokens_saved": tokens_saved,
         "answer_chars": len(answer_text),
-    }
+        "answer_cache_hit": False,
+    })
+
+# Answer qn using content retrival and RAG (tokens also go to the active stream sink)
+def answer_question(
+    question: str,
+    general_index_name: str,
+    patient_index_name: str,
+    session_id: str,
+    chat_history: Optional[List[Dict[str, str]]] = None,
+    patient_context: Optional[str] = None,
+    use_history: bool = True,
+) -> str:
+    sink = _token_sink.get()
+    parts: List[str] = []
+    for piece in stream_answer(
+        question, general_index_name, patient_index_name, session_id, chat_history, patient_context,
+        use_history=use_history,
+    ):
+        parts.append(piece)
+        if sink is not None:
+            sink(piece)
+    return "".join(parts)
+
+# Serve an answer that came from the semantic answer cache as if it had just been generated
+def replay_cached_answer(answer_text: str, context: str, latency_ms: float) -> str:
+    annotate(context=context, **{
+        "latency_ms_total": round(latency_ms, 1),
+        "latency_ms_first_token": round(latency_ms, 1),
+        "latency_ms_retrieval": 0.0,
+        "latency_ms_llm": 0.0,
+        "answer_cache_hit": True,
+        "used_patient_in_answer": "[patient]" in answer_text,
+        "used_helpbook_in_answer": "[helpbook]" in answer_text,
+        "context_chars": len(context),
+        "answer_chars": len(answer_text),
+    })
+    sink = _token_sink.get()
+    if sink is not None:
+        sink(answer_text)
     return answer_text
 
+# Per-turn views over the trace: every RAG answer in the turn, not just the last one
+def turn_context(root: tracing.Span) -> str:
+    return "\n".join(s.attrs.get("context", "") for s in root.find_all("rag.answer") if s.attrs.get("context"))
+
+def turn_metrics(root: tracing.Span) -> Dict[str, Any]:
+    """
+    Flat metrics for metrics.summarize_session: the last RAG answer's metrics plus
+    turn-level counts, wall time and per-stage totals (stage_ms_<span name>).
+    """
+    answers = root.find_all("rag.answer")
+    last = root.find("rag.answer")
+    m = {k: v for k, v in (last.attrs if last else {}).items() if k != "context"}
+    m.update(
+        latency_ms_turn=root.duration_ms,
+        rag_calls=len(answers),
+        llm_calls=sum(1 for s in root.walk() if s.kind == "llm"),
+        tool_calls=sum(1 for s in root.walk() if s.kind == "tool"),
+    )
+    for s in root.walk():
+        if s is not root:
+            key = f"stage_ms_{s.name}"
+            m[key] = round(m.get(key, 0.0) + s.duration_ms, 1)
+    return m
+
 def clear_session_memory(session_id: str):
-    _memory_store.pop(session_id, None)
+    get_history_store().clear(session_id)
+
+# Idle sessions collected by the janitor also lose their chat memory
+on_session_expired(clear_session_memory)
@@ -1,5 +1,18 @@
 # rag_tools.py
-from rag import answer_question
+import os
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+import answer_cache
+import labs
+from embeddings import get_embeddings
+from history import get_history_store
+from janitor import on_session_expired
+from rag import answer_question, replay_cached_answer
+from tracing import span
+from vectorstore import wait_for_session_vectors
 
 # This directive gets prepended to every query the agent sends to RAG.
 PATIENT_FIRST_PREFIX = (
@@ -10,33 +23,128 @@ PATIENT_FIRST_PREFIX = (
     "- Do NOT ask the user to upload the report; it is already ingested for this session.\n\n"
 )
 
-# Answers the patient's qn
-def _rag(question: str, general_index: str, patient_index: str, session_id: str) -> str:
-    return answer_question(
-        question=PATIENT_FIRST_PREFIX + question,
-        general_index_name=general_index,
-        patient_index_name=patient_index,
-        session_id=session_id,
-        chat_history=[],  # agent holds dialog memory
-    )
+# Retrieval outcomes an answer may be cached under (a timed-out/failed branch means partial context)
+_CACHEABLE_STATUSES = ("ok", "structured")
+
+# Answers the patient's qn (tokens stream to rag.stream_tokens_to's sink while generating)
+# Near-identical free-text questions on the same documents are served from answer_cache;
+# templated prompts pass cache_key and only ever match that exact key.
+# Free-text questions asked on top of earlier exchanges ("what does that mean?") depend on
+# that history, which the question vector does not capture, so they bypass the cache
+# Each call is one "rag.answer" span; its context/metrics land on that span
+def _rag(question: str, general_index: str, patient_index: str, session_id: str,
+         patient_context: Optional[str] = None, cache_key: Optional[str] = None,
+         use_history: bool = True) -> str:
+    with span("rag.answer", kind="rag", structured=patient_context is not None) as sp:
+        t0 = time.perf_counter()
+        cacheable = cache_key is not None or not (use_history and get_history_store().get(session_id).messages)
+        sp.set(answer_cache_eligible=cacheable)
+        question_vec = None
+        version = answer_cache.docs_version(session_id)
+        if cacheable:
+            # Key on the bare question: the shared prefix would make every question look alike
+            # (one extra query embedding; retrieval embeds the prefixed/expanded variants)
+            question_vec = get_embeddings().embed_query(question) if cache_key is None else None
+            hit = answer_cache.lookup(session_id, question_vec, key=cache_key)
+            if hit is not None:
+                answer, context = hit
+                return replay_cached_answer(answer, context, (time.perf_counter() - t0) * 1000)
+
+        answer = answer_question(
+            question=PATIENT_FIRST_PREFIX + question,
+            general_index_name=general_index,
+            patient_index_name=patient_index,
+            session_id=session_id,
+            chat_history=[],  # agent holds dialog memory
+            patient_context=patient_context,
+            use_history=use_history,
+        )
+        if cacheable and all(
+            sp.attrs.get(f"retrieval_status_{b}") in _CACHEABLE_STATUSES for b in ("patient", "helpbook")
+        ):
+            answer_cache.store(session_id, question_vec, answer, context=sp.attrs.get("context", ""),
+                               version=version, key=cache_key)
+        return answer
 
 def rag_tool(question: str, general_index: str, patient_index: str, session_id: str) -> str:
     return _rag(question, general_index, patient_index, session_id)
 
-# Summarising tool
+SUMMARY_PROMPT = (
+    "Summarise the current patient's uploaded lab/clinical report. "
+    "Pull concrete values with reference ranges, flag out-of-range items, "
+    "give a short clinical interpretation and next steps. Be concise and structured."
+)
+SUMMARY_WAIT_S = float(os.getenv("SUMMARY_WAIT_S", "120"))
+# How long the job waits for freshly upserted vectors to become queryable
+SUMMARY_INDEX_WAIT_S = float(os.getenv("SUMMARY_INDEX_WAIT_S", "60"))
+
+# One summary job per session, tied to the documents it was built from
+_summary_pool = ThreadPoolExecutor(max_workers=int(os.getenv("SUMMARY_WORKERS", "2")), thread_name_prefix="summary")
+_summary_jobs: Dict[str, Tuple[str, Future]] = {}
+_summary_lock = threading.Lock()
+
+def _build_summary(general_index: str, patient_index: str, session_id: str,
+                   min_vectors: int = 0) -> Tuple[str, str]:
+    # Runs on the summary pool: its own trace, not part of any chat turn
+    with span("summary_job", kind="request", session_id=session_id) as root:
+        # Summarising before the upload is searchable would cache an empty summary
+        if min_vectors and not wait_for_session_vectors(
+            patient_index, session_id, min_vectors, timeout_s=SUMMARY_INDEX_WAIT_S
+        ):
+            raise TimeoutError(f"Session vectors not queryable after {SUMMARY_INDEX_WAIT_S:.0f}s")
+        # The user never asked for this one: keep it out of their chat history
+        answer = _rag(SUMMARY_PROMPT, general_index, patient_index, session_id, use_history=False)
+        return answer, root.find("rag.answer").attrs.get("context", "")
+
+def start_summary_job(general_index: str, patient_index: str, session_id: str,
+                      min_vectors: int = 0) -> Future:
+    """
+    Start (or join) the background summary for the session's current documents.
+    Called right after ingest so the summary is usually ready before it is asked for;
+    min_vectors = vectors the session partition must report before retrieval is trusted.
+    """
+    version = answer_cache.docs_version(session_id)
+    with _summary_lock:
+        job = _summary_jobs.get(session_id)
+        if job is not None and job[0] == version:
+            return job[1]
+        fut = _summary_pool.submit(_build_summary, general_index, patient_index, session_id, min_vectors)
+        _summary_jobs[session_id] = (version, fut)
+        return fut
+
+def forget_summary(session_id: str):
+    with _summary_lock:
+        _summary_jobs.pop(session_id, None)
+
+# Summarising tool: returns the precomputed summary, or waits on the in-flight job
 def summarise_patient_report(general_index: str, patient_index: str, session_id: str) -> str:
-    prompt = (
-        "Summarise the current patient's uploaded lab/clinical report. "
-        "Pull concrete values with reference ranges, flag out-of-range items, "
-        "give a short clinical interpretation and next steps. Be concise and structured."
-    )
-    return _rag(prompt, general_index, patient_index, session_id)
+    t0 = time.perf_counter()
+    fut = start_summary_job(general_index, patient_index, session_id)
+    try:
+        answer, context = fut.result(timeout=SUMMARY_WAIT_S)
+    except Exception:
+        # Failed/stuck job: forget it and answer inline
+        forget_summary(session_id)
+        return _rag(SUMMARY_PROMPT, general_index, patient_index, session_id)
+    # A "rag.answer" span like a live answer, so turn_context/turn_metrics pick the summary up
+    with span("rag.answer", kind="rag", precomputed=True):
+        return replay_cached_answer(answer, context, (time.perf_counter() - t0) * 1000)
 
-# Interpret lab results
+# Interpret lab results: the value comes from the structured lab table (labs.py) when
+# the report had it; vector retrieval is then only used for helpbook context
 def interpret_lab(test_name: str, general_index: str, patient_index: str, session_id: str) -> str:
     prompt = (
         f"Interpret the patient's {test_name}. If present, cite the exact value and reference range "
         f"from the patient's documents and say if it is low/normal/high. "
         f"Add a brief, non-diagnostic explanation and what to discuss with a clinician."
     )
-    return _rag(prompt, general_index, patient_index, session_id)
+    records = labs.lookup(session_id, test_name)
+    facts = labs.format_records(records) if records else None
+    # Exact key per test: the template around {test_name} would make every test look alike
+    key = f"Interpret_Lab:{labs.normalize_test_name(test_name)}"
+    return _rag(prompt, general_index, patient_index, session_id, patient_context=facts, cache_key=key)
+
+# Idle sessions collected by the janitor also lose their cached answers and summary
+on_session_expired(answer_cache.forget_session)
+on_session_expired(forget_summary)
+on_session_expired(labs.forget_session)
@@ -0,0 +1,42 @@
+# ===========================================
+# file: resources.py
+# Process-wide registry of heavyweight shared resources
+# ===========================================
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+_registry: Dict[str, Any] = {}
+_build_ms: Dict[str, float] = {}
+_lock = threading.RLock()
+
+
+def get_resource(name: str, factory: Callable[[], Any]) -> Any:
+    """
+    Return the shared instance registered under `name`, building it with
+    factory() the first time. Every session/thread in the process gets the same object.
+    """
+    res = _registry.get(name)
+    if res is not None:
+        return res
+    with _lock:
+        if name not in _registry:
+            t0 = time.perf_counter()
+            _registry[name] = factory()
+            _build_ms[name] = round((time.perf_counter() - t0) * 1000, 1)
+        return _registry[name]
+
+
+def drop_resource(name: str):
+    with _lock:
+        _registry.pop(name, None)
+        _build_ms.pop(name, None)
+
+
+def resource_names() -> List[str]:
+    return sorted(_registry)
+
+
+def resource_build_times() -> Dict[str, float]:
+    """How long each shared resource took to build (ms)."""
+    return dict(_build_ms)
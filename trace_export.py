@@ -0,0 +1,189 @@
+# ===========================================
+# file: trace_export.py
+# Opt-in JSONL export of per-turn / per-ingest timings + sampling profiler
+# ===========================================
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from tracing import Span
+
+# Append one JSON line per turn / ingest here (unset = export off)
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "")
+# Fraction of turns to run under the sampling profiler (0 = only when asked explicitly)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_TOP_STACKS = int(os.getenv("PROFILE_TOP_STACKS", "25"))
+
+# Also write each turn's question (what bench.py replays); answers/context never are
+TRACE_EXPORT_QUESTIONS = os.getenv("TRACE_EXPORT_QUESTIONS", "0").lower() in ("1", "true", "yes")
+
+# Span attributes that carry document / user text: never written to disk
+_PRIVATE_ATTRS = {"context", "input"}
+
+# question -> text to export (None = leave it out); see set_question_redactor
+_redact_question: Callable[[str], Optional[str]] = lambda q: q
+
+_write_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return bool(TRACE_EXPORT_PATH)
+
+
+def export(record: Dict[str, Any], path: Optional[str] = None):
+    """Append one record as a JSON line (no-op when export is off)."""
+    path = path or TRACE_EXPORT_PATH
+    if not path:
+        return
+    line = json.dumps(record, default=str) + "\n"
+    with _write_lock:
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+def set_question_redactor(fn: Callable[[str], Optional[str]]):
+    """Hook applied to questions before export (e.g. mask names/IDs; return None to drop)."""
+    global _redact_question
+    _redact_question = fn
+
+
+def _scrub(tree: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        **tree,
+        "attrs": {k: v for k, v in tree["attrs"].items() if k not in _PRIVATE_ATTRS},
+        "children": [_scrub(c) for c in tree["children"]],
+    }
+
+
+def turn_record(root: Span, question: str = "", answer: str = "") -> Dict[str, Any]:
+    """
+    Flatten a turn's span tree:
+      stages         {span name: {"ms": total, "count": n}}  (retrieval per index, embed, llm, tools, ...)
+      agent_planning LLM calls made by the agent itself (not inside a RAG answer)
+      payload        sizes of question / answer / context
+      cache          answer-cache and query-embedding cache outcomes
+      question       only with TRACE_EXPORT_QUESTIONS (after the redaction hook)
+    """
+    stages: Dict[str, Dict[str, float]] = {}
+    planning = {"ms": 0.0, "count": 0}
+    cache = {"answer_cache_hits": 0, "answer_cache_misses": 0, "answer_cache_bypassed": 0,
+             "query_embed_hits": 0, "query_embed_misses": 0}
+    context_chars = 0
+    errors = []
+
+    def visit(sp: Span, in_rag: bool):
+        nonlocal context_chars
+        st = stages.setdefault(sp.name, {"ms": 0.0, "count": 0})
+        st["ms"] = round(st["ms"] + sp.duration_ms, 1)
+        st["count"] += 1
+        if sp.kind == "llm" and not in_rag:
+            planning["ms"] = round(planning["ms"] + sp.duration_ms, 1)
+            planning["count"] += 1
+        if sp.name == "rag.answer":
+            if sp.attrs.get("answer_cache_eligible") is False:
+                cache["answer_cache_bypassed"] += 1  # follow-up answered on top of chat history
+            else:
+                hit = bool(sp.attrs.get("answer_cache_hit"))
+                cache["answer_cache_hits" if hit else "answer_cache_misses"] += 1
+            context_chars += int(sp.attrs.get("context_chars", 0))
+        if sp.name == "embed.query":
+            cache["query_embed_hits" if sp.attrs.get("cache_hit") else "query_embed_misses"] += 1
+        if sp.status != "ok":
+            errors.append({"span": sp.name, "status": sp.status})
+        for c in list(sp.children):
+            visit(c, in_rag or sp.name == "rag.answer")
+
+    visit(root, False)
+    stages.pop(root.name, None)
+    exported_q = _redact_question(question) if TRACE_EXPORT_QUESTIONS and question else None
+    return {
+        "type": "turn",
+        "trace_id": root.attrs.get("trace_id") or uuid.uuid4().hex,
+        "ts": root.started_at,
+        "session_id": root.attrs.get("session_id"),
+        **({"question": exported_q} if exported_q else {}),
+        "duration_ms": root.duration_ms,
+        "stages": stages,
+        "agent_planning": planning,
+        "payload": {"question_chars": len(question), "answer_chars": len(answer), "context_chars": context_chars},
+        "cache": cache,
+        "errors": errors,
+        "profile": root.attrs.get("profile"),
+        "spans": _scrub(root.to_dict()),
+    }
+
+
+def export_turn(root: Span, question: str = "", answer: str = ""):
+    if enabled():
+        export(turn_record(root, question, answer))
+
+
+def export_ingest(kind: str, index_name: str, files: int, result: Dict[str, Any]):
+    """One record per ingest run; result is the dict the ingest function returns."""
+    if enabled():
+        export({"type": "ingest", "ts": time.time(), "kind": kind, "index": index_name,
+                "files": files, **result})
+
+
+# ----------------------------
+# Sampling profiler
+# ----------------------------
+class _Sampler(threading.Thread):
+    """Samples one thread's Python stack every interval; stacks are kept in folded form."""
+
+    def __init__(self, thread_id: int, interval_s: float):
+        super().__init__(name="trace-profiler", daemon=True)
+        self.thread_id = thread_id
+        self.interval_s = interval_s
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval_s):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            parts = []
+            while frame is not None:
+                code = frame.f_code
+                parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(parts))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+@contextmanager
+def profiling(root: Span, force: Optional[bool] = None) -> Iterator[None]:
+    """
+    Run the block under the sampling profiler when `force` is True, or on a
+    PROFILE_SAMPLE_RATE coin flip when it is None. The calling thread is sampled; the top stacks (folded "a;b;c" -> samples)
+    are stored on root.attrs["profile"] and so end up in the exported turn record.
+    """
+    on = force if force is not None else PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+    if not on:
+        yield
+        return
+    sampler = _Sampler(threading.get_ident(), PROFILE_INTERVAL_MS / 1000.0)
+    sampler.start()
+    try:
+        yield
+    finally:
+        sampler.stop()
+        root.set(profile={
+            "interval_ms": PROFILE_INTERVAL_MS,
+            "samples": sampler.samples,
+            "stacks": dict(sampler.stacks.most_common(PROFILE_TOP_STACKS)),
+        })
@@ -0,0 +1,136 @@
+# ===========================================
+# file: tracing.py
+# Request-scoped span tree carried through contextvars
+# ===========================================
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from typing import Any, Dict, Iterator, List, Optional
+
+# The span new work is attached to (one chain per request / thread / task)
+_current: ContextVar[Optional["Span"]] = ContextVar("trace_current_span", default=None)
+
+
+class Span:
+    """
+    One timed step of a request (turn, tool call, retrieval, embedding, LLM call).
+    Children may be added from worker threads, so the whole tree shares one lock.
+    """
+
+    def __init__(self, name: str, kind: str = "internal", parent: Optional["Span"] = None, **attrs: Any):
+        self.name = name
+        self.kind = kind
+        self.attrs: Dict[str, Any] = dict(attrs)
+        self.parent = parent
+        self.children: List["Span"] = []
+        self.status = "ok"
+        self.started_at = time.time()
+        self._t0 = time.perf_counter()
+        self._t1: Optional[float] = None
+        self._lock = parent._lock if parent is not None else threading.Lock()
+        if parent is not None:
+            with self._lock:
+                parent.children.append(self)
+
+    @property
+    def duration_ms(self) -> float:
+        end = self._t1 if self._t1 is not None else time.perf_counter()
+        return round((end - self._t0) * 1000, 1)
+
+    def set(self, **attrs: Any) -> "Span":
+        with self._lock:
+            self.attrs.update(attrs)
+        return self
+
+    def finish(self, status: Optional[str] = None):
+        if status:
+            self.status = status
+        if self._t1 is None:
+            self._t1 = time.perf_counter()
+
+    def walk(self) -> Iterator["Span"]:
+        yield self
+        with self._lock:
+            children = list(self.children)
+        for c in children:
+            yield from c.walk()
+
+    def find_all(self, name: str) -> List["Span"]:
+        return [s for s in self.walk() if s.name == name]
+
+    def find(self, name: str) -> Optional["Span"]:
+        """Most recently started span called `name` in this subtree."""
+        found = self.find_all(name)
+        return max(found, key=lambda s: s._t0) if found else None
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            attrs, children = dict(self.attrs), list(self.children)
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "started_at": self.started_at,
+            "duration_ms": self.duration_ms,
+            "status": self.status,
+            "attrs": attrs,
+            "children": [c.to_dict() for c in children],
+        }
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+def open_span(name: str, kind: str = "internal", **attrs: Any) -> Span:
+    """
+    Child of the current span that does NOT become current; call finish() yourself.
+    For generators, where a contextvar set on one next() may be reset on another.
+    """
+    return Span(name, kind, _current.get(), **attrs)
+
+
+@contextmanager
+def span(name: str, kind: str = "internal", **attrs: Any) -> Iterator[Span]:
+    """
+    Time the block as a child of the current span (or as a new root when there is none):
+        with span("retrieval.patient", kind="retrieval", k=10) as sp:
+            ...
+            sp.set(docs=len(docs))
+    """
+    sp = Span(name, kind, _current.get(), **attrs)
+    token = _current.set(sp)
+    try:
+        yield sp
+    except GeneratorExit:
+        sp.status = "cancelled"
+        raise
+    except BaseException as e:
+        sp.status = f"error: {e}"
+        raise
+    finally:
+        sp.finish()
+        _current.reset(token)
+
+
+@contextmanager
+def start_trace(name: str = "turn", **attrs: Any) -> Iterator[Span]:
+    """A new root span, independent of anything already running in this context."""
+    token = _current.set(None)
+    try:
+        with span(name, kind="request", **attrs) as root:
+            yield root
+    finally:
+        _current.reset(token)
+
+
+def annotate(**attrs: Any):
+    """Attach attributes to the current span, if any."""
+    sp = _current.get()
+    if sp is not None:
+        sp.set(**attrs)
+
+
+def submit(pool, fn, *args, **kwargs):
+    """pool.submit() that carries the caller's trace into the worker thread."""
+    return pool.submit(copy_context().run, fn, *args, **kwargs)
@@ -1,53 +1,383 @@
 # ===========================================
 # file: vectorstore.py
-# Pinecone v3 setup and vectorstore helpers
+# Vector backends (Pinecone v3 / local NumPy) and vectorstore helpers
 # ===========================================
 import os
-from typing import List, Optional
+import time
+import threading
+from typing import Dict, List, Optional
 from pinecone import Pinecone, ServerlessSpec
+from pinecone.exceptions import NotFoundException
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
 from langchain_pinecone import PineconeVectorStore
 from embeddings import get_embeddings
+from local_index import LocalIndex, LocalVectorStore
 
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 
 
 DEFAULT_REGION = os.getenv("PINECONE_REGION", "us-east-1")
-EMBED_DIM = 384  # Google text-embedding-004
+EMBED_DIM = 384  # all-MiniLM-L6-v2
 
-def _pc() -> Pinecone:
-    if not PINECONE_API_KEY:
+# "pinecone" (default) or "local" (in-process NumPy index under LOCAL_INDEX_DIR)
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "pinecone").lower()
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", ".vector_index")
+
+# How long list_indexes() results are trusted before asking Pinecone again
+INDEX_CACHE_TTL_S = float(os.getenv("INDEX_CACHE_TTL_S", "300"))
+
+
+# Patient vectors are partitioned per session: one namespace per session_id
+def session_namespace(session_id: str) -> str:
+    return f"session-{session_id}"
+
+
+class VectorBackend:
+    """What the app needs from a vector database."""
+
+    def ensure_indexes(self, index_names: List[str], region: str = DEFAULT_REGION):
+        raise NotImplementedError
+
+    def get_vectorstore(self, index_name: str, namespace: Optional[str] = None) -> VectorStore:
+        """namespace=None is the shared (default) partition of the index."""
+        raise NotImplementedError
+
+    def upsert_vectors(self, index_name: str, ids: List[str], vectors: List[List[float]],
+                       texts: List[str], metadatas: List[dict], namespace: Optional[str] = None):
+        """Write already-embedded chunks (no re-encoding), replacing rows with the same id."""
+        raise NotImplementedError
+
+    def fetch_metadata(self, index_name: str, ids: List[str],
+                       namespace: Optional[str] = None) -> Dict[str, dict]:
+        """Stored metadata for whichever of `ids` already exist (missing ids are left out)."""
+        raise NotImplementedError
+
+    def update_metadata(self, index_name: str, updates: Dict[str, dict], namespace: Optional[str] = None):
+        """Merge fields into the metadata of existing rows without re-embedding them."""
+        raise NotImplementedError
+
+    def delete_session(self, index_name: str, session_id: str):
+        """Drop the session's whole partition."""
+        raise NotImplementedError
+
+    def session_vector_count(self, index_name: str, session_id: str) -> int:
+        """Vectors still visible in the session's partition (0 once a delete has landed)."""
+        raise NotImplementedError
+
+    def drop_index(self, index_name: str):
+        raise NotImplementedError
+
+
+# Shared Pinecone clients, one per API key, reused by every request in the process
+_pc_clients: Dict[str, Pinecone] = {}
+_pc_clients_lock = threading.Lock()
+
+def _pc_client(api_key: Optional[str] = None) -> Pinecone:
+    api_key = api_key or PINECONE_API_KEY
+    if not api_key:
         raise RuntimeError("Missing PINECONE_API_KEY")
-    return Pinecone(api_key=PINECONE_API_KEY)
+    with _pc_clients_lock:
+        if api_key not in _pc_clients:
+            _pc_clients[api_key] = Pinecone(api_key=api_key)
+        return _pc_clients[api_key]
+
+
+class PineconeBackend(VectorBackend):
+    """
+    Pinecone serverless. Keeps one client and one Index handle per index name,
+    and caches list_indexes() for INDEX_CACHE_TTL_S (invalidated on create/drop).
+    """
+
+    def __init__(self, index_cache_ttl_s: float = INDEX_CACHE_TTL_S):
+        self.index_cache_ttl_s = index_cache_ttl_s
+        self._lock = threading.Lock()
+        self._handles: Dict[str, object] = {}
+        self._names: Optional[set] = None
+        self._names_at = 0.0
+
+    def _pc(self) -> Pinecone:
+        return _pc_client()
+
+    def _index(self, index_name: str):
+        with self._lock:
+            if index_name not in self._handles:
+                self._handles[index_name] = self._pc().Index(index_name)
+            return self._handles[index_name]
+
+    def _index_names(self) -> set:
+        with self._lock:
+            if self._names is not None and time.monotonic() - self._names_at < self.index_cache_ttl_s:
+                return set(self._names)
+        names = {i["name"] for i in self._pc().list_indexes().indexes}
+        with self._lock:
+            self._names, self._names_at = names, time.monotonic()
+        return set(names)
+
+    def _invalidate(self, index_name: Optional[str] = None):
+        with self._lock:
+            self._names = None
+            if index_name:
+                self._handles.pop(index_name, None)
+
+    # Check if indexes are present.. if not create them
+    def ensure_indexes(self, index_names: List[str], region: str = DEFAULT_REGION):
+        existing = self._index_names()
+
+        for name in index_names:
+            if name not in existing:
+                self._pc().create_index(
+                    name=name,
+                    dimension=EMBED_DIM,
+                    metric="cosine",
+                    spec=ServerlessSpec(cloud="aws", region=region or DEFAULT_REGION),
+                )
+                self._invalidate(name)
+
+    def get_vectorstore(self, index_name: str, namespace: Optional[str] = None) -> PineconeVectorStore:
+        # LangChain VectorStore wrapper over the shared Index handle; reads/writes stay in one namespace
+        return PineconeVectorStore(
+            index=self._index(index_name),
+            embedding=get_embeddings(),
+            namespace=namespace,
+        )
+
+    def upsert_vectors(self, index_name: str, ids: List[str], vectors: List[List[float]],
+                       texts: List[str], metadatas: List[dict], namespace: Optional[str] = None):
+        # Same record layout as PineconeVectorStore.add_texts (chunk text under "text")
+        records = [
+            {"id": i, "values": v, "metadata": {**(m or {}), "text": t}}
+            for i, v, t, m in zip(ids, vectors, texts, metadatas)
+        ]
+        self._index(index_name).upsert(vectors=records, namespace=namespace)
+
+    def fetch_metadata(self, index_name: str, ids: List[str],
+                       namespace: Optional[str] = None) -> Dict[str, dict]:
+        if not ids:
+            return {}
+        res = self._index(index_name).fetch(ids=list(ids), namespace=namespace)
+        out = {}
+        for i, vec in (res.vectors or {}).items():
+            meta = dict(vec.metadata or {})
+            meta.pop("text", None)  # chunk text lives in metadata on Pinecone
+            out[i] = meta
+        return out
+
+    def update_metadata(self, index_name: str, updates: Dict[str, dict], namespace: Optional[str] = None):
+        idx = self._index(index_name)
+        for i, meta in updates.items():
+            idx.update(id=i, set_metadata=meta, namespace=namespace)
+
+    def delete_session(self, index_name: str, session_id: str):
+        idx = self._index(index_name)
+        # Drop the session's namespace in one call (no metadata scan)
+        # Note: Deletion is async; immediate count is not returned.
+        try:
+            idx.delete(delete_all=True, namespace=session_namespace(session_id))
+        except NotFoundException:
+            # Serverless 404s on a namespace that does not exist: nothing left to purge
+            pass
+
+    def session_vector_count(self, index_name: str, session_id: str) -> int:
+        stats = self._index(index_name).describe_index_stats()
+        ns = (stats.get("namespaces") or {}).get(session_namespace(session_id)) or {}
+        return int(ns.get("vector_count", 0))
+
+    def drop_index(self, index_name: str):
+        try:
+            self._pc().delete_index(index_name)
+        finally:
+            self._invalidate(index_name)
+
+
+class LocalBackend(VectorBackend):
+    """
+    Offline backend: each index is a LocalIndex directory under LOCAL_INDEX_DIR
+    (normalised float32 vectors in a memory-mapped file); each namespace is its own
+    LocalIndex under <index>/namespaces/<namespace>. One LocalIndex object per
+    partition per process, shared by every caller.
+    """
+
+    def __init__(self, root: str = LOCAL_INDEX_DIR):
+        self.root = root
+        self._indexes: Dict[tuple, LocalIndex] = {}
+        self._lock = threading.Lock()
+
+    def _path(self, index_name: str, namespace: Optional[str] = None) -> str:
+        if namespace:
+            return os.path.join(self.root, index_name, "namespaces", namespace)
+        return os.path.join(self.root, index_name)
+
+    def _index(self, index_name: str, namespace: Optional[str] = None) -> LocalIndex:
+        key = (index_name, namespace or "")
+        with self._lock:
+            if key not in self._indexes:
+                self._indexes[key] = LocalIndex(self._path(index_name, namespace), EMBED_DIM)
+            return self._indexes[key]
+
+    def ensure_indexes(self, index_names: List[str], region: str = DEFAULT_REGION):
+        for name in index_names:
+            self._index(name)
+
+    def get_vectorstore(self, index_name: str, namespace: Optional[str] = None) -> LocalVectorStore:
+        return LocalVectorStore(self._index(index_name, namespace), get_embeddings())
+
+    def upsert_vectors(self, index_name: str, ids: List[str], vectors: List[List[float]],
+                       texts: List[str], metadatas: List[dict], namespace: Optional[str] = None):
+        self._index(index_name, namespace).upsert(ids, vectors, texts, metadatas)
+
+    def fetch_metadata(self, index_name: str, ids: List[str],
+                       namespace: Optional[str] = None) -> Dict[str, dict]:
+        return self._index(index_name, namespace).get_metadata(ids)
+
+    def update_metadata(self, index_name: str, updates: Dict[str, dict], namespace: Optional[str] = None):
+        self._index(index_name, namespace).update_metadata(updates)
+
+    def _drop(self, index_name: str, namespace: Optional[str] = None):
+        with self._lock:
+            idx = self._indexes.pop((index_name, namespace or ""), None)
+            if not namespace:
+                # Dropping the index drops all of its namespaces too
+                for key in [k for k in self._indexes if k[0] == index_name]:
+                    self._indexes.pop(key)
+        if idx is None:
+            path = self._path(index_name, namespace)
+            if not os.path.isdir(path):
+                return
+            idx = LocalIndex(path, EMBED_DIM)
+        idx.drop()
+
+    def delete_session(self, index_name: str, session_id: str):
+        self._drop(index_name, session_namespace(session_id))
+
+    def session_vector_count(self, index_name: str, session_id: str) -> int:
+        # Local deletes are synchronous
+        path = self._path(index_name, session_namespace(session_id))
+        return len(self._index(index_name, session_namespace(session_id))) if os.path.isdir(path) else 0
+
+    def drop_index(self, index_name: str):
+        self._drop(index_name)
+
+
+_BACKENDS = {"pinecone": PineconeBackend, "local": LocalBackend}
+_backend: Optional[VectorBackend] = None
+_backend_lock = threading.Lock()
+
+
+def get_backend() -> VectorBackend:
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if VECTOR_BACKEND not in _BACKENDS:
+                    raise RuntimeError(f"Unknown VECTOR_BACKEND '{VECTOR_BACKEND}' (use one of {sorted(_BACKENDS)})")
+                _backend = _BACKENDS[VECTOR_BACKEND]()
+    return _backend
+
+
 # Check if indexes are present.. if not create them
 def ensure_indexes(general_index_name: str, patient_index_name: str, region: str = DEFAULT_REGION):
-    pc = _pc()
-    existing = {i["name"] for i in pc.list_indexes().indexes}
-
-    for name in [general_index_name, patient_index_name]:
-        if name not in existing:
-            pc.create_index(
-                name=name,
-                dimension=EMBED_DIM,
-                metric="cosine",
-                spec=ServerlessSpec(cloud="aws", region=region or DEFAULT_REGION),
-            )
-
-# get the index contents
-def get_vectorstore(index_name: str) -> PineconeVectorStore:
-    # LangChain VectorStore wrapper (auto-connects by name)
-    return PineconeVectorStore(
-        index_name=index_name,
-        embedding=get_embeddings(),
-        # pinecone_api_key pulled from env automatically
+    get_backend().ensure_indexes([general_index_name, patient_index_name], region=region)
+
+# get the index contents (optionally one namespace/partition of it)
+def get_vectorstore(index_name: str, namespace: Optional[str] = None) -> VectorStore:
+    return get_backend().get_vectorstore(index_name, namespace=namespace)
+
+# Write chunks that were embedded elsewhere (ingest's embed stage)
+def upsert_vectors(
+    index_name: str,
+    ids: List[str],
+    vectors: List[List[float]],
+    texts: List[str],
+    metadatas: List[dict],
+    namespace: Optional[str] = None,
+):
+    get_backend().upsert_vectors(index_name, ids, vectors, texts, metadatas, namespace=namespace)
+
+# Existing rows by id (idempotent ingest checks these before embedding anything)
+def fetch_metadata(index_name: str, ids: List[str], namespace: Optional[str] = None) -> Dict[str, dict]:
+    return get_backend().fetch_metadata(index_name, ids, namespace=namespace)
+
+def update_metadata(index_name: str, updates: Dict[str, dict], namespace: Optional[str] = None):
+    get_backend().update_metadata(index_name, updates, namespace=namespace)
+
+# Searches that take an already-computed query vector (no re-encoding)
+def mmr_search_by_vector(
+    vs: VectorStore,
+    embedding: List[float],
+    k: int,
+    fetch_k: int,
+    lambda_mult: float,
+    filter: Optional[dict] = None,
+) -> List[Document]:
+    return vs.max_marginal_relevance_search_by_vector(
+        embedding, k=k, fetch_k=fetch_k, lambda_mult=lambda_mult, filter=filter
     )
 
-def delete_patient_session_vectors(patient_index_name: str, session_id: str):
-    pc = _pc()
-    idx = pc.Index(patient_index_name)
-    # Delete by metadata filter: all chunks for this session
-    # Note: Deletion is async; immediate count is not returned.
-    idx.delete(filter={"session_id": {"$eq": session_id}})
+def similarity_search_by_vector(
+    vs: VectorStore,
+    embedding: List[float],
+    k: int,
+    filter: Optional[dict] = None,
+) -> List[Document]:
+    hits = vs.similarity_search_by_vector_with_score(embedding, k=k, filter=filter)
+    return [d for d, _ in hits]
+
+def delete_patient_session_vectors(
+    patient_index_name: str,
+    session_id: str,
+    wait: bool = False,
+    timeout_s: float = 30.0,
+    poll_s: float = 1.0,
+) -> bool:
+    """
+    Purge only this session's vectors (other sessions are untouched).
+    Pinecone deletes are eventually consistent; with wait=True, poll until the
+    session partition reports 0 vectors or timeout_s passes.
+    Returns True if the purge is known to have landed.
+    """
+    backend = get_backend()
+    backend.delete_session(patient_index_name, session_id)
+    if not wait:
+        return False
+    deadline = time.monotonic() + timeout_s
+    while True:
+        if backend.session_vector_count(patient_index_name, session_id) == 0:
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(poll_s)
+
+def session_vector_count(patient_index_name: str, session_id: str) -> int:
+    return get_backend().session_vector_count(patient_index_name, session_id)
+
+def wait_for_session_vectors(
+    patient_index_name: str,
+    session_id: str,
+    at_least: int,
+    timeout_s: float = 60.0,
+    poll_s: float = 1.0,
+) -> bool:
+    """
+    Pinecone upserts become queryable a little after they return; poll until the
+    session partition reports at least `at_least` vectors. False on timeout.
+    """
+    backend = get_backend()
+    deadline = time.monotonic() + timeout_s
+    while True:
+        if backend.session_vector_count(patient_index_name, session_id) >= at_least:
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(poll_s)
 
 def drop_patient_index(patient_index_name: str):
-    pc = _pc()
-    pc.delete_index(patient_index_name)
+    get_backend().drop_index(patient_index_name)
+
+
+# Index creation is a deployment step:  python vectorstore.py
+if __name__ == "__main__":
+    general = os.getenv("GENERAL_INDEX_NAME", "medical-helpbook")
+    patient = os.getenv("PATIENT_INDEX_NAME", "patient-reports")
+    ensure_indexes(general, patient, region=DEFAULT_REGION)
+    print(f"Indexes ready ({VECTOR_BACKEND}): {general}, {patient}")
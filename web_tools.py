@@ -1,6 +1,7 @@
 # web_tools.py
 from langchain.agents import Tool
 from langchain_community.tools import DuckDuckGoSearchRun, DuckDuckGoSearchResults
+from resources import get_resource
 
 def get_web_tools(num_results: int = 5):
     """
@@ -9,8 +10,11 @@ def get_web_tools(num_results: int = 5):
       - WEB_SEARCH_RESULTS: top-N results (titles + snippets)
     """
     # Under the hood these are BaseTool subclasses; we expose them as Tool(func=...).
-    ddg_quick = DuckDuckGoSearchRun()                   # .run(query) -> str
-    ddg_results = DuckDuckGoSearchResults(num_results=num_results)  # .run(query) -> str
+    # The search clients are stateless, so one pair is shared by every session.
+    ddg_quick = get_resource("ddg_quick", DuckDuckGoSearchRun)                   # .run(query) -> str
+    ddg_results = get_resource(
+        f"ddg_results:{num_results}", lambda: DuckDuckGoSearchResults(num_results=num_results)
+    )  # .run(query) -> str
 
     # define web search tool
     WEB_SEARCH_QUICK = Tool(